@@ -1,21 +1,31 @@
 import os
 import sys
-import re
-import concurrent
+import time
 
 import pandas as pd
 import streamlit as st
 
-from helpers.format import extract_tags
+from helpers.format import extract_tags, format_bytes, format_duration
+from helpers.downloads import download_table
+from helpers.io import UPLOAD_TYPES, read_table
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from services.llm_service import generate, supported_models
+from services.llm_service import FailedResponse, iter_generate_many, supported_models
+from services.hedging import HedgePolicy
+from services.journal import RunJournal, make_row_key, make_run_id
+from services.batch_api import (BatchError, fetch_results, forget_batch, pending_batch, remember_batch, submit_batch,
+                                supports_batch, wait_for_batch)
+from services import metrics
+from services.data_store import DataStore, total_nbytes
+from prompts.templates import PromptTemplate
 
 st.set_page_config(page_title='Prompt/Eval Testing', page_icon='🤖', layout='wide')
 
 st.title('Prompt Testing')
 
 SYSTEM_PROMPT_TEXT_BOX_HEIGHT = 300
+# seconds between redraws of the partial results table while a batch runs
+RESULTS_REFRESH_INTERVAL = 2.0
 
 if 'tag' not in st.session_state:
     st.session_state.tag = False
@@ -23,16 +33,26 @@ if 'tag' not in st.session_state:
 if 'available_columns' not in st.session_state:
     st.session_state.available_columns = []
 
+# the table lives in a versioned store; `dataframe` is a no-copy view of its current version
+if 'data_store' not in st.session_state:
+    st.session_state.data_store = DataStore()
+
 if 'dataframe' not in st.session_state:
     st.session_state.dataframe = pd.DataFrame()
 
+
+def refresh_dataframe():
+    st.session_state.dataframe = st.session_state.data_store.frame()
+
+
 with st.sidebar:
-    # upload from CSV
-    st.subheader("Upload from csv")
-    uploaded_file = st.file_uploader("Upload transcripts from .csv")
+    # upload from CSV, Parquet or Arrow
+    st.subheader("Upload transcripts")
+    uploaded_file = st.file_uploader("Upload transcripts from .csv, .parquet or .arrow", type=UPLOAD_TYPES)
     if st.button('Populate (warning, will overwrite)'):
         if uploaded_file is not None:
-            st.session_state.dataframe = pd.read_csv(uploaded_file)
+            st.session_state.data_store.load(read_table(uploaded_file))
+            refresh_dataframe()
 
     st.markdown('---')
     column_to_extract_transcript = st.selectbox(label="Column to extract tag from",
@@ -41,12 +61,44 @@ with st.sidebar:
     tag_end = st.text_input(label="Tag end", value="<end_of_transcript>")
     column_name_for_extracted_transcript = st.text_input(label="Name of new columns", value="extracted_transcript")
 
+    st.markdown('---')
+    st.subheader("Run settings")
+    use_cache = st.checkbox("Reuse cached responses", value=True,
+                            help="Untick to resample rows whose prompt and model have not changed.")
+    resume_runs = st.checkbox("Resume interrupted runs", value=True,
+                              help="Rows already completed by an identical run that was interrupted or had "
+                                   "failures are reused from its checkpoint instead of being sent again.")
+    batch_deadline_minutes = st.number_input("Batch deadline (minutes, 0 for none)", min_value=0, value=0,
+                                             help="Rows still running when it passes are marked as failed.")
+    hedge_requests = st.checkbox("Hedge slow requests",
+                                 help="Re-send a request once it is slower than 95% of recent calls to the same "
+                                      "model, and keep whichever copy answers first.")
+    hedge_fallback_model = st.selectbox("Hedge with", ["Same model"] + list(supported_models.__args__),
+                                        disabled=not hedge_requests)
+    offline_batch = st.checkbox("Submit as an offline batch",
+                                help="Send every row in one provider batch job (OpenAI models only). Results "
+                                     "take up to 24 hours but cost half as much; if the app restarts, running "
+                                     "the same job again picks the batch back up instead of resubmitting it.")
+
     if st.button('Extract transcript columns'):
         if st.session_state.dataframe is not None:
             if column_name_for_extracted_transcript in st.session_state.dataframe.columns.tolist():
-                st.session_state.dataframe[column_name_for_extracted_transcript] = st.session_state.dataframe[
-                    column_to_extract_transcript].apply(
-                    lambda x: extract_tags(x, tag_start, tag_end))
+                st.session_state.data_store.with_column(
+                    column_name_for_extracted_transcript,
+                    st.session_state.dataframe[column_to_extract_transcript].apply(
+                        lambda x: extract_tags(x, tag_start, tag_end)),
+                    label=f"Extract {column_name_for_extracted_transcript}")
+                refresh_dataframe()
+
+    st.markdown('---')
+    data_store = st.session_state.data_store
+    if st.button('Undo last change', disabled=len(data_store.history) < 2,
+                 help="Go back to the table as it was before the last upload, extraction, added transcript or run."):
+        data_store.undo()
+        refresh_dataframe()
+    st.caption(f"Data: {data_store.current.num_rows} rows, {format_bytes(data_store.nbytes())} over "
+               f"{len(data_store.history)} versions ({format_bytes(total_nbytes())} across all sessions). "
+               f"Last change: {data_store.history[-1]}")
 
 col_left, col_right = st.columns(2)
 
@@ -70,10 +122,9 @@ def update_dataframe_display():
 
 if st.button('Add Transcript'):
     if new_transcript:
-        st.session_state.dataframe = pd.concat(
-            [st.session_state.dataframe, pd.DataFrame({'transcripts': [new_transcript]})],
-            ignore_index=True
-        )
+        st.session_state.data_store.append_rows(pd.DataFrame({'transcripts': [new_transcript]}),
+                                                label="Add transcript")
+        refresh_dataframe()
         update_dataframe_display()
         st.success('Transcript added!')
     else:
@@ -81,53 +132,128 @@ if st.button('Add Transcript'):
 
 available_columns = st.session_state.dataframe.columns.tolist()
 
+hedge_policy = None
+if hedge_requests:
+    hedge_policy = HedgePolicy(fallback_model=None if hedge_fallback_model == "Same model" else hedge_fallback_model)
+
 
 def update_available_columns():
     st.session_state.available_columns = st.session_state.dataframe.columns.tolist()
 
 
-def parse_selected_cols(user_prompt):
-    return re.findall("{{([a-zA-Z_\s]*)}}", user_prompt)
+def unknown_columns(user_prompt):
+    return PromptTemplate(user_prompt).missing(available_columns)
 
 
-def generate_text(df, system_prompt, user_prompt, new_col_name, model_type):
-    results = df.copy()
-    total = len(results)
-    progress_bar = st.progress(0)
+def iter_batch_results(run_id, requests, custom_ids, progress_bar):
+    """Submit (or re-attach to) the offline batch for a run, wait for it, then yield each request's response."""
+    batch_id = pending_batch(run_id)
+    if batch_id is None:
+        batch_id = submit_batch(requests, custom_ids)
+        remember_batch(run_id, batch_id)
 
-    if not user_prompt:
-        prompt = ''
+    def show_status(batch):
+        counts = batch.get("request_counts") or {}
+        finished = counts.get("completed", 0) + counts.get("failed", 0)
+        progress_bar.progress(finished / max(counts.get("total") or len(requests), 1),
+                              text=f"Batch {batch_id} {batch['status']}: {finished}/{len(requests)} rows")
 
-    selected_cols = parse_selected_cols(user_prompt)
+    batch = wait_for_batch(batch_id, on_status=show_status)
+    responses = fetch_results(batch)
+    forget_batch(run_id)
+    for index, custom_id in enumerate(custom_ids):
+        response = responses.get(custom_id)
+        if response is None:
+            response = FailedResponse.from_exception(BatchError(f"batch {batch['status']} before this row ran"))
+        yield index, response
 
-    for selected_col in selected_cols:
-        if selected_col not in available_columns:
-            st.warning(f'Warning: {selected_col} is not a valid column.')
 
-    def process_row(row):
-        interpolated_user_prompt = user_prompt
-        for column in selected_cols:
-            if column in available_columns:
-                interpolated_user_prompt = interpolated_user_prompt.replace("{{" + column + "}}",
-                                                                            str(row[column]))
+def generate_text(data_store, system_prompt, user_prompt, new_col_name, model_type, use_cache=True,
+                  deadline_minutes=0, hedge=None, resume=True, batch=False):
+    # the new column is collected on its own and added to the store as one more version at the end,
+    # so the table isn't copied for the run
+    df = data_store.frame()
+    total = len(df)
+    progress_bar = st.progress(0)
 
+    def build_request(content):
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": interpolated_user_prompt}
+            {"role": "user", "content": content}
         ]
 
-        return generate(messages, model_type)
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results_list = list(executor.map(process_row, [row for _, row in results.iterrows()]))
+        return {"messages": messages, "model_type": model_type, "use_cache": use_cache, "hedge": hedge}
+
+    # the template is parsed once and filled a column at a time; its columns were checked before the run
+    requests = [build_request(content) for content in PromptTemplate(user_prompt).render_all(df)]
+    outputs = [None] * total
+
+    # every completed row is checkpointed, so an interrupted run can pick up where it stopped
+    journal = RunJournal(make_run_id("generate", system_prompt, user_prompt, model_type, new_col_name))
+    if not resume:
+        journal.reset()
+    checkpointed = journal.completed()
+    row_keys = [make_row_key(index, request["messages"]) for index, request in zip(df.index, requests)]
+    pending = []
+    for position, row_key in enumerate(row_keys):
+        if (row_key, "", 0) in checkpointed:
+            outputs[position] = checkpointed[(row_key, "", 0)]
+        else:
+            pending.append(position)
+    resumed = total - len(pending)
+
+    counters_before = metrics.snapshot()
+    started = time.monotonic()
+    last_refresh = started
+    completed = resumed
+    num_failed = 0
+    # fill the column as rows finish so partial output is visible (and downloadable from the table) mid-run
+    pending_requests = [requests[position] for position in pending]
+    if batch:
+        outcomes = iter_batch_results(journal.run_id, pending_requests, [row_keys[position] for position in pending],
+                                      progress_bar)
+    else:
+        outcomes = ((completion.index, completion.response) for completion in iter_generate_many(
+            pending_requests, deadline=deadline_minutes * 60 or None, capture_errors=True))
+    for index, response in outcomes:
+        position = pending[index]
+        outputs[position] = response
+        completed += 1
+        if isinstance(response, FailedResponse):
+            num_failed += 1
+        else:
+            journal.record(row_keys[position], response)
+
+        now = time.monotonic()
+        rate = (completed - resumed) / max(now - started, 1e-9)
+        progress_bar.progress(completed / total,
+                              text=f"{completed}/{total} rows · {rate:.1f} rows/s · "
+                                   f"ETA {format_duration((total - completed) / rate)}")
+        if now - last_refresh >= RESULTS_REFRESH_INTERVAL:
+            # Arrow-backed columns make this copy cheap
+            st.session_state.dataframe = df.assign(**{new_col_name: outputs})
+            dataframe_container.dataframe(st.session_state.dataframe, use_container_width=True)
+            last_refresh = now
+    if not num_failed:
+        # a finished run isn't resumed: the same prompt run again is sent afresh (or served from the cache)
+        journal.finish()
+    journal.close()
+    run_stats = metrics.since(counters_before)
 
-    progress_bar.progress(1)
-    results[new_col_name] = results_list
     progress_bar.empty()
+    st.caption(f"{completed - resumed} rows in {format_duration(time.monotonic() - started)}"
+               f" | Resumed from checkpoint: {resumed}"
+               f" | Cache: {int(run_stats.get('cache.hits', 0))} hits, {int(run_stats.get('cache.misses', 0))} misses"
+               f" | Retries: {int(run_stats.get('retry.retries', 0))}"
+               f" | Hedges: {int(run_stats.get('hedge.fired', 0))} fired, {int(run_stats.get('hedge.won', 0))} won"
+               f" | Prompt cache: {int(run_stats.get('prompt_cache.read_tokens', 0))} of"
+               f" {int(run_stats.get('tokens.prompt', 0))} prompt tokens")
+    if num_failed:
+        st.warning(f'{num_failed} of {total} rows failed; the error is recorded in the "{new_col_name}" column.')
+    data_store.with_column(new_col_name, outputs, label=f"Generate {new_col_name}")
+    refresh_dataframe()
     update_available_columns()
 
-    return results
-
 
 with col_left:
     gen_system_prompt = st.text_area("System Prompt", height=SYSTEM_PROMPT_TEXT_BOX_HEIGHT,
@@ -149,14 +275,23 @@ with col_left:
             st.error("Please add at least one transcript.")
         elif not gen_new_column_name:
             st.error("Please enter a name for the new column.")
+        elif unknown_columns(gen_user_prompt):
+            st.error(f"Unknown column(s) in the user prompt: {', '.join(unknown_columns(gen_user_prompt))}")
+        elif offline_batch and not supports_batch(gen_model_type):
+            st.error(f"Offline batches are only available for OpenAI models, not {gen_model_type}.")
         else:
             with st.spinner('Generating outputs...'):
-                st.session_state.dataframe = generate_text(
-                    st.session_state.dataframe,
+                generate_text(
+                    st.session_state.data_store,
                     gen_system_prompt,
                     gen_user_prompt,
                     gen_new_column_name,
-                    gen_model_type
+                    gen_model_type,
+                    use_cache,
+                    batch_deadline_minutes,
+                    hedge_policy,
+                    resume_runs,
+                    offline_batch
                 )
 
             st.success("Generation complete!")
@@ -183,23 +318,26 @@ with col_right:
             st.error("Please add at least one transcript.")
         elif not eval_new_column_name:
             st.error("Please enter a name for the new column.")
+        elif unknown_columns(eval_user_prompt):
+            st.error(f"Unknown column(s) in the user prompt: {', '.join(unknown_columns(eval_user_prompt))}")
+        elif offline_batch and not supports_batch(eval_model_type):
+            st.error(f"Offline batches are only available for OpenAI models, not {eval_model_type}.")
         else:
             with st.spinner('Generating outputs...'):
-                st.session_state.dataframe = generate_text(
-                    st.session_state.dataframe,
+                generate_text(
+                    st.session_state.data_store,
                     eval_system_prompt,
                     eval_user_prompt,
                     eval_new_column_name,
-                    eval_model_type
+                    eval_model_type,
+                    use_cache,
+                    batch_deadline_minutes,
+                    hedge_policy,
+                    resume_runs,
+                    offline_batch
                 )
 
             st.success("Evaluation complete!")
             update_dataframe_display()
 
-csv = st.session_state.dataframe.to_csv(index=False).encode('utf-8')
-st.download_button(
-    label="Download Results as CSV",
-    data=csv,
-    file_name="llm_generation_results.csv",
-    mime="text/csv",
-)
+download_table(st.session_state.dataframe, st.session_state.data_store.version, "llm_generation_results")
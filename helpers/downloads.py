@@ -0,0 +1,37 @@
+import uuid
+from typing import Optional
+
+import pandas as pd
+import streamlit as st
+
+from .io import FORMAT_LABELS, TABLE_FORMATS, table_bytes
+
+
+def new_version() -> str:
+    """A fresh version id for a table that just changed; exports are cached per version."""
+    return uuid.uuid4().hex
+
+
+@st.cache_resource(max_entries=4, show_spinner="Preparing download...")
+def export_payload(version: str, fmt: str, _df: pd.DataFrame) -> bytes:
+    # keyed on the version rather than the frame, so a cache hit costs nothing however large the table is
+    return table_bytes(_df, fmt)
+
+
+def download_table(df: pd.DataFrame, version: Optional[str], file_name: str, key: str = "export"):
+    """
+    Format picker and download button for `df`. The table is only serialized once someone asks for it,
+    and the payload is reused on every rerun until `version` changes.
+    """
+    fmt = st.selectbox("Download format", list(TABLE_FORMATS), key=f"{key}_format")
+    if st.session_state.get(f"{key}_prepared") != (version, fmt):
+        if not st.button(f"Prepare {FORMAT_LABELS[fmt]} download", key=f"{key}_prepare"):
+            return
+        st.session_state[f"{key}_prepared"] = (version, fmt)
+    st.download_button(
+        label=f"Download Results as {FORMAT_LABELS[fmt]}",
+        data=export_payload(version, fmt, df),
+        file_name=f"{file_name}.{fmt}",
+        mime=TABLE_FORMATS[fmt],
+        key=f"{key}_download",
+    )
@@ -9,3 +9,26 @@ def extract_tags(text, tag_start, tag_end):
         return match.group(1).strip()
     else:
         return None
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    return f"{minutes}m {seconds:02d}s" if minutes else f"{seconds}s"
+
+
+def format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_stream_stats(stats):
+    if stats.cached:
+        return "From cache"
+    ttft = f"{stats.time_to_first_token:.2f}s" if stats.time_to_first_token is not None else "n/a"
+    speed = f"{stats.tokens_per_second:.1f} tokens/s" if stats.tokens_per_second is not None else "n/a"
+    return f"Time to first token: {ttft} · {speed}"
@@ -0,0 +1,101 @@
+import io
+import os
+from typing import IO, Any, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+# download formats and their mime types; Arrow is the IPC file format (the same bytes as Feather v2)
+TABLE_FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+FORMAT_LABELS = {"csv": "CSV", "parquet": "Parquet", "arrow": "Arrow"}
+# extensions accepted on upload
+UPLOAD_TYPES = ["csv", "parquet", "arrow", "feather"]
+# rows serialized at a time on export (CSV chunks, Parquet row groups, Arrow record batches)
+CHUNK_ROWS = 10_000
+
+
+def table_format(name: str) -> str:
+    """"csv", "parquet" or "arrow" from a file name's extension (anything unknown is read as CSV)."""
+    extension = os.path.splitext(name)[1].lstrip(".").lower()
+    if extension == "parquet":
+        return "parquet"
+    if extension in ("arrow", "feather", "ipc"):
+        return "arrow"
+    return "csv"
+
+
+def read_table(source: Union[str, IO[bytes]], name: Optional[str] = None) -> pd.DataFrame:
+    """
+    Read a CSV, Parquet or Arrow table from a path or an uploaded file. List-valued columns in Parquet
+    and Arrow files come back as Python lists, the same as the evaluation pages produce them.
+    """
+    fmt = table_format(name or getattr(source, "name", None) or str(source))
+    if fmt == "csv":
+        return pd.read_csv(source)
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(source) if fmt == "parquet" else feather.read_table(source)
+    df = table.to_pandas()
+    for field in table.schema:
+        if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+            # pandas would give numpy arrays, turning missing integer scores into NaN floats
+            df[field.name] = pd.Series(table.column(field.name).to_pylist(), index=df.index, dtype=object)
+    return df
+
+
+def table_bytes(df: pd.DataFrame, fmt: str = "csv") -> bytes:
+    """Serialize `df` (without its index) for download in one of TABLE_FORMATS."""
+    buffer = io.BytesIO()
+    write_table(df, buffer, fmt)
+    return buffer.getvalue()
+
+
+def write_table(df: pd.DataFrame, destination: Union[str, IO[bytes]], fmt: Optional[str] = None,
+                chunk_rows: int = CHUNK_ROWS):
+    """
+    Write `df` to a path or file object as CSV, Parquet or Arrow (by default, by the path's extension),
+    `chunk_rows` rows at a time, so a large table is never held as one giant string on top of the frame.
+    """
+    fmt = fmt or table_format(str(destination))
+    if fmt == "csv":
+        df.to_csv(destination, index=False, chunksize=chunk_rows, encoding='utf-8')
+        return
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    table = to_arrow(df)
+    if fmt == "parquet":
+        pq.write_table(table, destination, row_group_size=chunk_rows)
+    else:
+        feather.write_feather(table, destination, chunksize=chunk_rows)
+
+
+def to_arrow(df: pd.DataFrame):
+    """
+    `df` as an Arrow table. Lists of scores or responses become native list columns; an object column
+    Arrow can't type (e.g. scores mixed with "n/a" strings) is stored as strings rather than failing the export.
+    """
+    import pyarrow as pa
+
+    return pa.Table.from_arrays([arrow_array(df[column]) for column in df.columns],
+                                names=[str(column) for column in df.columns])
+
+
+def arrow_array(values: Union[pd.Series, Sequence[Any]]):
+    """One column as an Arrow array, falling back to strings for values Arrow can't give a single type."""
+    import pyarrow as pa
+
+    try:
+        return pa.array(values, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if _is_missing(value) else str(value) for value in values])
+
+
+def _is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and np.isnan(value))
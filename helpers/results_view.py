@@ -0,0 +1,88 @@
+import math
+from typing import Any, Dict, NamedTuple, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+PAGE_SIZES = [10, 25, 50, 100]
+QUANTILES = [0, 0.25, 0.5, 0.75, 1]
+QUANTILE_NAMES = ["min", "p25", "median", "p75", "max"]
+
+
+class ScoreSummary(NamedTuple):
+    """Aggregates of one criterion's scores over every row and iteration of a run."""
+    count: int  # scored iterations
+    mean: float
+    std: float
+    quantiles: Dict[str, float]  # min, p25, median, p75, max
+    histogram: pd.DataFrame  # one row per distinct score: score, count
+    row_mean: pd.Series  # per row, indexed like the results
+    row_std: pd.Series
+
+
+def summarize_scores(score_lists: Sequence[Sequence[Any]], index: Optional[pd.Index] = None) -> ScoreSummary:
+    """
+    Vectorized summary of per-row score lists (None for failed or unscored iterations). The lists are
+    packed into one NaN-padded rows x iterations array, so the cost is a few NumPy passes, not a Python
+    loop per score.
+    """
+    lengths = np.fromiter((len(scores) for scores in score_lists), dtype=int, count=len(score_lists))
+    width = int(lengths.max()) if len(lengths) else 0
+    matrix = np.full((len(lengths), width), np.nan)
+    flat = [score for scores in score_lists for score in scores]
+    matrix[np.arange(width) < lengths[:, None]] = np.array(flat, dtype=float)
+
+    valid = ~np.isnan(matrix)
+    counts = valid.sum(axis=1)
+    filled = np.where(valid, matrix, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row_mean = filled.sum(axis=1) / counts
+        squares = np.where(valid, (matrix - row_mean[:, None]) ** 2, 0.0).sum(axis=1)
+        row_std = np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+
+    values = matrix[valid]
+    if len(values):
+        quantiles = dict(zip(QUANTILE_NAMES, np.quantile(values, QUANTILES).tolist()))
+        mean, std = float(values.mean()), float(values.std(ddof=1)) if len(values) > 1 else math.nan
+    else:
+        quantiles = dict.fromkeys(QUANTILE_NAMES, math.nan)
+        mean = std = math.nan
+    distinct, occurrences = np.unique(values, return_counts=True)
+    index = index if index is not None else pd.RangeIndex(len(lengths))
+    return ScoreSummary(
+        count=len(values), mean=mean, std=std, quantiles=quantiles,
+        histogram=pd.DataFrame({"score": distinct, "count": occurrences}),
+        row_mean=pd.Series(row_mean, index=index), row_std=pd.Series(row_std, index=index)
+    )
+
+
+def select_rows(scores: pd.DataFrame, filter_column: Optional[str] = None, low: Optional[float] = None,
+                high: Optional[float] = None, sort_column: Optional[str] = None,
+                descending: bool = False) -> pd.Index:
+    """
+    Index of the rows to show, from a numeric frame with one score column per criterion: rows whose
+    `filter_column` score lies in [low, high] (unscored rows drop out once a filter is set), ordered by
+    `sort_column` with unscored rows last, or in their original order.
+    """
+    selected = scores
+    if filter_column is not None:
+        column = selected[filter_column]
+        keep = column.notna()
+        if low is not None:
+            keep &= column >= low
+        if high is not None:
+            keep &= column <= high
+        selected = selected[keep]
+    if sort_column is not None:
+        selected = selected.sort_values(sort_column, ascending=not descending, na_position='last', kind='stable')
+    return selected.index
+
+
+def page_count(num_rows: int, page_size: int) -> int:
+    return max(1, math.ceil(num_rows / page_size))
+
+
+def page_of(index: pd.Index, page: int, page_size: int) -> pd.Index:
+    """The slice of `index` shown on 1-based `page`."""
+    start = (page - 1) * page_size
+    return index[start:start + page_size]
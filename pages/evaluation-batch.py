@@ -1,23 +1,39 @@
-import concurrent
 import os
 import sys
-import re
+import altair as alt
 import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt  # Added for plotting
-from services.llm_service import generate, supported_models
-from prompts.evaluation_prompts import get_criteria
+from helpers.downloads import download_table, new_version
+from helpers.io import UPLOAD_TYPES, read_table
+from helpers.results_view import PAGE_SIZES, page_count, page_of, select_rows, summarize_scores
+from services.llm_service import iter_generate_samples, supported_models
+from services.data_store import DataStore
+from services.hedging import HedgePolicy
+from services.sampling import DEFAULT_CI_WIDTH, iter_sample_until_converged
+from prompts.evaluation_prompts import get_criteria, render_evaluation_inputs, score_response
 
 st.set_page_config(page_title='Lyrebird Note Evaluation', page_icon='', layout='wide')
 
 st.title('Lyrebird Note Evaluation')
 
+NO_FILTER = "No filter"
+ROW_ORDER = "Row order"
+
+if 'data_store' not in st.session_state:
+    st.session_state['data_store'] = DataStore()
+
 if 'dataframe' not in st.session_state:
     st.session_state['dataframe'] = pd.DataFrame()
 
 if 'results' not in st.session_state:
     st.session_state['results'] = pd.DataFrame()
 
+if 'summaries' not in st.session_state:
+    st.session_state['summaries'] = {}
+
+if 'run_id' not in st.session_state:
+    st.session_state['run_id'] = None
+
 if 'criteria' not in st.session_state:
     st.session_state['criteria'] = get_criteria()
 
@@ -27,11 +43,23 @@ if 'models' not in st.session_state:
 with st.sidebar:
     st.subheader("Model Selection")
     selected_model = st.selectbox("Choose a model:", st.session_state['models'])
+    hedge_requests = st.checkbox("Hedge slow requests",
+                                 help="Re-send a request once it is slower than 95% of recent calls, "
+                                      "and keep whichever copy answers first.")
+    early_stopping = st.checkbox("Stop sampling once scores converge",
+                                 help="Draw iterations for each note and criterion only until the 95% "
+                                      "confidence interval on its mean score is narrower than the target width.")
+    target_ci_width = st.number_input("Target confidence interval width", min_value=0.0, value=DEFAULT_CI_WIDTH,
+                                      step=0.1, disabled=not early_stopping)
 
     st.subheader("Upload Data")
-    uploaded_file = st.file_uploader("Upload CSV", type=['csv'])
+    uploaded_file = st.file_uploader("Upload CSV, Parquet or Arrow", type=UPLOAD_TYPES)
     if uploaded_file is not None:
-        st.session_state['dataframe'] = pd.read_csv(uploaded_file)
+        # parse an upload once, not again on every rerun while it sits in the uploader
+        if st.session_state.get('uploaded_file_id') != uploaded_file.file_id:
+            st.session_state['data_store'].load(read_table(uploaded_file))
+            st.session_state['dataframe'] = st.session_state['data_store'].frame()
+            st.session_state['uploaded_file_id'] = uploaded_file.file_id
         st.success("Data uploaded successfully!")
 
     if not st.session_state['dataframe'].empty:
@@ -45,101 +73,122 @@ with st.sidebar:
         st.warning("Please upload data to select columns.")
 
 
-def get_user_prompt(input_required, notes, transcript):
-    if input_required == 'notes':
-        return f'''NOTES: {notes}'''
-    elif input_required == 'transcript':
-        return f'''TRANSCRIPT: {transcript}'''
-    elif input_required == 'both':
-        return f'''NOTES: {notes}\nTRANSCRIPT: {transcript}'''
+def evaluate_notes(df, notes_col, transcript_col, criteria_list, model_type, hedge=None, ci_width=None):
+    # a shallow copy: the result columns are added alongside the input's without duplicating it
+    results = df.copy(deep=False)
+    num_iters = 10  # with a ci_width this is the most any note gets
+
+    # every (criterion, row) pair is one request; all their samples are queued at once
+    units = [(criterion, row_idx) for criterion in criteria_list for row_idx in range(len(df))]
+    user_prompts = render_evaluation_inputs(df, notes_col, transcript_col, criteria_list)
+    requests = [
+        {
+            "messages": [
+                {
+                    "role": "system", "content": criterion['prompt']
+                },
+                {
+                    "role": "user",
+                    "content": user_prompts[criterion['input_required']][row_idx]
+                }
+            ],
+            "model_type": model_type,
+            "hedge": hedge
+        }
+        for criterion, row_idx in units
+    ]
+
+    # one global queue with a bounded number in flight, shared fairly between criteria
+    groups = [criterion['title'] for criterion, _ in units]
+
+    # Initialize lists to hold scores and responses for all iterations
+    all_scores = {criterion['title']: [[None] * num_iters for _ in range(len(df))] for criterion in criteria_list}
+    all_responses = {criterion['title']: [[None] * num_iters for _ in range(len(df))] for criterion in criteria_list}
+
+    if ci_width is None:
+        for completion in iter_generate_samples(requests, num_iters, capture_errors=True, groups=groups):
+            criterion, row_idx = units[completion.index]
+            title = criterion['title']
+            all_scores[title][row_idx][completion.sample] = score_response(completion.response, criterion['type'])
+            all_responses[title][row_idx][completion.sample] = completion.response
     else:
-        return ''
+        def score(index, response):
+            return score_response(response, units[index][0]['type'])
 
+        for result in iter_sample_until_converged(requests, score, num_iters, ci_width, capture_errors=True,
+                                                  groups=groups):
+            criterion, row_idx = units[result.index]
+            all_scores[criterion['title']][row_idx] = result.scores
+            all_responses[criterion['title']][row_idx] = result.responses
 
-def evaluate_notes(df, notes_col, transcript_col, criteria_list, model_type):
-    results = df.copy()
+        samples_used = sum(len(scores) for per_row in all_scores.values() for scores in per_row)
+        st.caption(f"Used {samples_used} of {num_iters * len(units)} samples")
 
     for criterion in criteria_list:
         title = criterion['title']
-        response_type = criterion['type']  # 'list' or 'score'
-        num_iters = 10  # Default to 1 if not specified
-
-        # Initialize lists to hold scores and responses for all iterations
-        all_scores_per_row = [[] for _ in range(len(df))]
-        all_responses_per_row = [[] for _ in range(len(df))]
-
-        for iteration in range(num_iters):
-            def process_row(row):
-                notes = row[notes_col]
-                transcript = row[transcript_col]
-
-                messages = [
-                    {
-                        "role": "system", "content": criterion['prompt']
-                    },
-                    {
-                        "role": "user", "content": get_user_prompt(criterion['input_required'], notes, transcript)
-                    }
-                ]
-
-                response = generate(messages, model_type)
-
-                if response_type == 'list':
-                    num_items = len([line for line in response.strip().split('\n') if line.strip()])
-                    score = num_items
-                elif response_type == 'score':
-                    try:
-                        score = int(re.findall(r'\d+', response)[-1])
-                    except:
-                        score = None
-                else:
-                    score = None
-
-                return score, response
-
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                results_list = list(executor.map(process_row, [row for _, row in df.iterrows()]))
-
-            for idx, (score, response) in enumerate(results_list):
-                all_scores_per_row[idx].append(score)
-                all_responses_per_row[idx].append(response)
-
-        # After all iterations, store the scores and responses
-        results[f"{title} Scores"] = all_scores_per_row
-        results[f"{title} Responses"] = all_responses_per_row
+        results[f"{title} Scores"] = all_scores[title]
+        results[f"{title} Responses"] = all_responses[title]
 
     return results
 
 
-def display_results(results_df, notes_col):
+def summarize_results(results_df, criteria_list):
+    """Per-criterion aggregates of a finished run, computed once and kept with its results."""
+    return {
+        criterion['title']: summarize_scores(results_df[f"{criterion['title']} Scores"], results_df.index)
+        for criterion in criteria_list
+    }
+
+
+@st.cache_data(max_entries=32)
+def score_chart(run_id, title, _histogram):
+    # built once per run and criterion; `_histogram` is left out of the cache key since the run id pins it
+    return alt.Chart(_histogram).mark_bar().encode(
+        x=alt.X('score:O', title='Score'),
+        y=alt.Y('count:Q', title='Responses')
+    ).properties(title=f"{title} Scores", height=240)
+
+
+def display_results(results_df, notes_col, summaries, run_id):
     st.write("Evaluation Results")
 
-    # Display box plots for each criterion
+    # Score distribution for each criterion
     for criterion in st.session_state['criteria']:
         title = criterion['title']
-        score_col = f"{title} Scores"
-
-        # Collect all scores from all rows and iterations
-        all_scores = []
-        for scores in results_df[score_col]:
-            # Filter out None values
-            filtered_scores = [s for s in scores if s is not None]
-            all_scores.extend(filtered_scores)
-            print(all_scores)
-
-        if all_scores:
-            # Plot the box plot
-            st.write(f"**Box plot for {title}:**")
-            fig, ax = plt.subplots()
-            ax.boxplot(all_scores, vert=True)
-            ax.set_title(f"{title} Scores")
-            ax.set_ylabel('Scores')
-            st.pyplot(fig)
+        summary = summaries[title]
+        if summary.count:
+            quantiles = summary.quantiles
+            st.write(f"**Scores for {title}:** mean {summary.mean:.2f} ± {summary.std:.2f}, "
+                     f"median {quantiles['median']:g} (IQR {quantiles['p25']:g}-{quantiles['p75']:g}, "
+                     f"range {quantiles['min']:g}-{quantiles['max']:g}) over {summary.count} responses")
+            st.altair_chart(score_chart(run_id, title, summary.histogram), use_container_width=True)
         else:
             st.write(f"No valid scores to plot for {title}.")
 
-    # Display individual results
-    for idx, row in results_df.iterrows():
+    # Display individual results, by average score over the iterations
+    score_table = pd.DataFrame({title: summary.row_mean for title, summary in summaries.items()})
+
+    # filter and sort on the score table, then render the full responses for the visible page only
+    titles = [criterion['title'] for criterion in st.session_state['criteria']]
+    filter_col, low_col, high_col, sort_col, order_col = st.columns(5)
+    filter_title = filter_col.selectbox("Filter by", [NO_FILTER] + titles)
+    low = low_col.number_input("Min score", value=None, disabled=filter_title == NO_FILTER)
+    high = high_col.number_input("Max score", value=None, disabled=filter_title == NO_FILTER)
+    sort_title = sort_col.selectbox("Sort by", [ROW_ORDER] + titles)
+    descending = order_col.checkbox("Highest first", value=True, disabled=sort_title == ROW_ORDER)
+    shown = select_rows(score_table, None if filter_title == NO_FILTER else filter_title, low, high,
+                        None if sort_title == ROW_ORDER else sort_title, descending)
+
+    st.caption(f"{len(shown)} of {len(results_df)} notes")
+    # the grid only draws the rows in view, so it can hold every selected row
+    st.dataframe(score_table.loc[shown], use_container_width=True)
+
+    size_col, page_col = st.columns(2)
+    page_size = size_col.selectbox("Notes per page", PAGE_SIZES)
+    page = page_col.number_input("Page", min_value=1, max_value=page_count(len(shown), page_size), value=1)
+
+    for idx in page_of(shown, page, page_size):
+        row = results_df.loc[idx]
         with st.expander(f"**Note {idx + 1}:**"):
             st.write(row[notes_col])
         for criterion in st.session_state['criteria']:
@@ -148,7 +197,10 @@ def display_results(results_df, notes_col):
             response_col = f"{title} Responses"
             scores = row[score_col]
             responses = row[response_col]
-            with st.expander(f"{title} - Scores: {scores}, Average: {(sum(scores) / len(scores)):.2f}"):
+            # failed iterations have no score
+            mean, std = summaries[title].row_mean[idx], summaries[title].row_std[idx]
+            average = "n/a" if pd.isna(mean) else f"{mean:.2f}" if pd.isna(std) else f"{mean:.2f} ± {std:.2f}"
+            with st.expander(f"{title} - Scores: {scores}, Average: {average}"):
                 for i, (score, response) in enumerate(zip(scores, responses)):
                     st.write(f"**Iteration {i + 1}:** Score: {score}")
                     st.write(response)
@@ -166,18 +218,18 @@ if not st.session_state['dataframe'].empty:
                 st.session_state['notes_column'],
                 st.session_state['transcript_column'],
                 st.session_state['criteria'],
-                selected_model
+                selected_model,
+                HedgePolicy() if hedge_requests else None,
+                target_ci_width if early_stopping else None
             )
             st.session_state['results'] = results
+            st.session_state['summaries'] = summarize_results(results, st.session_state['criteria'])
+            st.session_state['run_id'] = new_version()
             st.success("Evaluation complete!")
 
     if not st.session_state['results'].empty:
-        display_results(st.session_state['results'], st.session_state['notes_column'])
-
-        csv = st.session_state['results'].to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="Download Results as CSV",
-            data=csv,
-            file_name="evaluation_results.csv",
-            mime="text/csv",
-        )
+        display_results(st.session_state['results'], st.session_state['notes_column'],
+                        st.session_state['summaries'], st.session_state['run_id'])
+
+        # Parquet and Arrow keep per-iteration score and response lists as list columns
+        download_table(st.session_state['results'], st.session_state['run_id'], "evaluation_results")
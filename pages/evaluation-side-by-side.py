@@ -1,11 +1,12 @@
 import concurrent
 import os
 import sys
-import re
 import pandas as pd
 import streamlit as st
-from services.llm_service import generate, supported_models
-from prompts.evaluation_prompts import get_criteria
+from helpers.io import FORMAT_LABELS, TABLE_FORMATS, table_bytes
+from services.llm_service import supported_models
+from services.sampling import DEFAULT_CI_WIDTH, MIN_SAMPLES, iter_sample_until_converged, mean_difference
+from prompts.evaluation_prompts import get_criteria, render_evaluation_inputs, score_response
 
 st.set_page_config(page_title='Lyrebird Note Evaluation', page_icon='', layout='wide')
 
@@ -21,80 +22,110 @@ with st.sidebar:
     st.subheader("Model Selection")
     selected_model = st.selectbox("Choose a model:", st.session_state['models'])
     st.subheader("Settings")
+    num_versions = st.number_input("Number of versions", min_value=2, max_value=6, value=2)
     num_iters = st.number_input("Number of iterations", min_value=1, value=1)
+    early_stopping = st.checkbox("Stop sampling once scores converge",
+                                 help="Treat the number of iterations as a budget and stop sampling a criterion "
+                                      "once the 95% confidence interval on its mean score is narrower than the "
+                                      "target width.")
+    target_ci_width = st.number_input("Target confidence interval width", min_value=0.0, value=DEFAULT_CI_WIDTH,
+                                      step=0.1, disabled=not early_stopping)
 
 st.session_state['transcript'] = st.text_area("Enter your transcript")
 
-col1, col2 = st.columns(2)
-
-with col1:
-    st.subheader("Version A")
-    notes_a = st.text_area("Enter notes for Version A")
-
-with col2:
-    st.subheader("Version B")
-    notes_b = st.text_area("Enter notes for Version B")
-
-
-def get_user_prompt(input_required, notes, transcript):
-    match input_required:
-        case 'notes':
-            return f'''NOTES: {notes}'''
-        case 'transcript':
-            return f'''TRANSCRIPT: {transcript}'''
-        case 'both':
-            return f'''NOTES: {notes}
-TRANSCRIPT: {transcript}'''
-
-
-def evaluate_notes_versions(notes_dict, transcript, criteria_list, model_type, num_iters):
-    results = {}
-    for version_label, notes in notes_dict.items():
-        print(transcript, notes)
-        version_results = {}
-        for criterion in criteria_list:
-            title = criterion['title']
-            response_type = criterion['type']  # 'list' or 'score'
-
-            total_score = 0
-            total_responses = []
-            for _ in range(num_iters):
-                messages = [
-                    {
-                        "role": "system", "content": criterion['prompt']
-                    },
-                    {
-                        "role": "user", "content": get_user_prompt(criterion['input_required'], notes, transcript)
-                    }
-                ]
-                response = generate(messages, model_type)
-
-                if response_type == 'list':
-                    num_items = len([line for line in response.strip().split('\n') if line.strip()])
-                    score = num_items
-                elif response_type == 'score':
-                    try:
-                        score = int(re.findall(r'\d+', response)[-1])
-                    except:
-                        score = None
-                else:
-                    score = None
-
-                if score is not None:
-                    total_score += score
-                total_responses.append(response)
-
-            average_score = total_score / num_iters if total_score is not None else None
-            version_results[title] = {'score': average_score, 'responses': total_responses}
-        results[version_label] = version_results
-    return results
+version_labels = [chr(ord('A') + i) for i in range(num_versions)]
+version_cols = st.columns(num_versions)
+notes_dict = {}
+for version_label, col in zip(version_labels, version_cols):
+    with col:
+        st.subheader(f"Version {version_label}")
+        notes_dict[version_label] = st.text_area(f"Enter notes for Version {version_label}")
+
+
+def comparison_summary(results, criteria_list):
+    """Each version's mean score per criterion against version A, with a 95% interval on the difference."""
+    baseline_label = next(iter(results))
+    rows = []
+    for criterion in criteria_list:
+        title = criterion['title']
+        baseline = results[baseline_label].get(title)
+        for version_label, version_results in results.items():
+            if version_label == baseline_label:
+                continue
+            current = version_results.get(title)
+            if not baseline or not current or not baseline['scores'] or not current['scores']:
+                continue
+            difference, half_width = mean_difference(current['scores'], baseline['scores'])
+            rows.append({
+                'Criteria': title,
+                'Version': version_label,
+                f'Mean {baseline_label}': baseline['score'],
+                'Mean': current['score'],
+                f'Difference vs {baseline_label}': difference,
+                'CI low': difference - half_width,
+                'CI high': difference + half_width,
+                'Significant': abs(difference) > half_width,
+            })
+    return pd.DataFrame(rows)
+
+
+def evaluate_notes_versions(notes_dict, transcript, criteria_list, model_type, num_iters, ci_width=None,
+                            summary_placeholder=None):
+    units = [(version_label, criterion) for version_label in notes_dict for criterion in criteria_list]
+    # the same NOTES/TRANSCRIPT messages as the other evaluation pages, one row per version
+    versions = pd.DataFrame({'notes': list(notes_dict.values()), 'transcript': transcript}, index=list(notes_dict))
+    user_prompts = {
+        input_required: dict(zip(versions.index, prompts))
+        for input_required, prompts in render_evaluation_inputs(versions, 'notes', 'transcript',
+                                                                criteria_list).items()
+    }
+    requests = [
+        {
+            "messages": [
+                {
+                    "role": "system", "content": criterion['prompt']
+                },
+                {
+                    "role": "user",
+                    "content": user_prompts[criterion['input_required']][version_label]
+                }
+            ],
+            "model_type": model_type,
+            "use_cache": num_iters == 1
+        }
+        for version_label, criterion in units
+    ]
+
+    def score(index, response):
+        return score_response(response, units[index][1]['type'])
+
+    # without early stopping every unit draws its full budget up front
+    min_samples = num_iters if ci_width is None else min(MIN_SAMPLES, num_iters)
+    results = {version_label: {} for version_label in notes_dict}
+    for result in iter_sample_until_converged(requests, score, num_iters, ci_width or 0.0, min_samples,
+                                              capture_errors=True):
+        version_label, criterion = units[result.index]
+        valid_scores = [s for s in result.scores if s is not None]
+        average_score = sum(valid_scores) / len(valid_scores) if valid_scores else None
+        results[version_label][criterion['title']] = {
+            'score': average_score, 'scores': valid_scores, 'responses': result.responses
+        }
+        # refresh the comparison as each (version, criterion) cell finishes
+        if summary_placeholder is not None:
+            summary_placeholder.dataframe(comparison_summary(results, criteria_list), use_container_width=True)
+
+    # keep the criteria in their configured order
+    return {
+        version_label: {criterion['title']: version_results[criterion['title']] for criterion in criteria_list}
+        for version_label, version_results in results.items()
+    }
 
 
 def display_results_versions(version_label, version_results):
     for criterion_title, criterion_result in version_results.items():
         average_score = criterion_result['score']
         responses = criterion_result['responses']
-        st.write(f"**{criterion_title}** - Average Score: {average_score}")
+        st.write(f"**{criterion_title}** - Average Score: {average_score} ({len(responses)} samples)")
         with st.expander(f"Responses for {criterion_title}"):
             for i, response in enumerate(responses):
                 st.markdown(f"Iteration {i + 1}:")
@@ -102,27 +133,31 @@ def display_results_versions(version_label, version_results):
         st.markdown("---")
 
 
-if st.session_state['transcript'] and notes_a and notes_b:
+if st.session_state['transcript'] and all(notes_dict.values()):
     if st.button("Run Evaluation"):
+        st.subheader("Comparison")
+        summary_placeholder = st.empty()
         with st.spinner("Evaluating..."):
-            notes_dict = {'A': notes_a, 'B': notes_b}
             results = evaluate_notes_versions(
                 notes_dict,
                 st.session_state['transcript'],
                 st.session_state['criteria'],
                 selected_model,
-                num_iters
+                num_iters,
+                target_ci_width if early_stopping else None,
+                summary_placeholder
             )
             st.session_state['results'] = results
             st.success("Evaluation complete!")
+    elif 'results' in st.session_state:
+        st.subheader("Comparison")
+        st.dataframe(comparison_summary(st.session_state['results'], st.session_state['criteria']),
+                     use_container_width=True)
 
     if 'results' in st.session_state:
-        result_items = list(st.session_state['results'].items())
-
-        with col1:
-            display_results_versions(result_items[0][0], result_items[0][1])
-        with col2:
-            display_results_versions(result_items[1][0], result_items[1][1])
+        for col, (version_label, version_results) in zip(version_cols, st.session_state['results'].items()):
+            with col:
+                display_results_versions(version_label, version_results)
 
         # Prepare data for CSV export
         data = {'Criteria': []}
@@ -135,13 +170,17 @@ if st.session_state['transcript'] and notes_a and notes_b:
             for version_label in versions:
                 score = st.session_state['results'][version_label][title]['score']
                 data[version_label].append(score)
+        for version_label in versions:
+            # every sample's score; Parquet and Arrow keep these as list columns
+            data[f"{version_label} Scores"] = [st.session_state['results'][version_label][criterion['title']]['scores']
+                                               for criterion in st.session_state['criteria']]
         results_df = pd.DataFrame(data)
-        csv = results_df.to_csv(index=False).encode('utf-8')
+        export_format = st.selectbox("Download format", list(TABLE_FORMATS))
         st.download_button(
-            label="Download Results as CSV",
-            data=csv,
-            file_name="evaluation_results.csv",
-            mime="text/csv",
+            label=f"Download Results as {FORMAT_LABELS[export_format]}",
+            data=table_bytes(results_df, export_format),
+            file_name=f"evaluation_results.{export_format}",
+            mime=TABLE_FORMATS[export_format],
         )
 else:
-    st.warning("Please enter the transcript and notes for both versions to proceed.")
+    st.warning("Please enter the transcript and notes for every version to proceed.")
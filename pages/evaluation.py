@@ -1,22 +1,37 @@
-import concurrent
 import os
 import sys
-import re
+from functools import partial
 import pandas as pd
 import streamlit as st
-from services.llm_service import generate, supported_models
-from prompts.evaluation_prompts import get_criteria
+from helpers.downloads import download_table, new_version
+from helpers.io import UPLOAD_TYPES, read_table
+from helpers.results_view import PAGE_SIZES, page_count, page_of, select_rows
+from services.llm_service import FailedResponse, iter_generate_many, supported_models
+from services.data_store import DataStore
+from services.hedging import HedgePolicy
+from services.journal import RunJournal, make_row_key, make_run_id
+from prompts.evaluation_prompts import (get_criteria, is_complete_response, render_evaluation_inputs, score_response,
+                                        split_response)
 
 st.set_page_config(page_title='Lyrebird Note Evaluation', page_icon='', layout='wide')
 
 st.title('Lyrebird Note Evaluation')
 
+NO_FILTER = "No filter"
+ROW_ORDER = "Row order"
+
+if 'data_store' not in st.session_state:
+    st.session_state['data_store'] = DataStore()
+
 if 'dataframe' not in st.session_state:
     st.session_state['dataframe'] = pd.DataFrame()
 
 if 'results' not in st.session_state:
     st.session_state['results'] = pd.DataFrame()
 
+if 'results_version' not in st.session_state:
+    st.session_state['results_version'] = None
+
 if 'criteria' not in st.session_state:
     st.session_state['criteria'] = get_criteria()
 
@@ -26,11 +41,24 @@ if 'models' not in st.session_state:
 with st.sidebar:
     st.subheader("Model Selection")
     selected_model = st.selectbox("Choose a model:", st.session_state['models'])
+    hedge_requests = st.checkbox("Hedge slow requests",
+                                 help="Re-send a request once it is slower than 95% of recent calls, "
+                                      "and keep whichever copy answers first.")
+    resume_runs = st.checkbox("Resume interrupted runs", value=True,
+                              help="Rows already scored by an identical run that was interrupted or had "
+                                   "failures are reused from its checkpoint instead of being sent again.")
+    fuse_criteria = st.checkbox("Score all criteria in one request",
+                                help="Ask for every criterion in a single prompt so each note and transcript "
+                                     "is sent once instead of once per criterion.")
 
     st.subheader("Upload Data")
-    uploaded_file = st.file_uploader("Upload CSV", type=['csv'])
+    uploaded_file = st.file_uploader("Upload CSV, Parquet or Arrow", type=UPLOAD_TYPES)
     if uploaded_file is not None:
-        st.session_state['dataframe'] = pd.read_csv(uploaded_file)
+        # parse an upload once, not again on every rerun while it sits in the uploader
+        if st.session_state.get('uploaded_file_id') != uploaded_file.file_id:
+            st.session_state['data_store'].load(read_table(uploaded_file))
+            st.session_state['dataframe'] = st.session_state['data_store'].frame()
+            st.session_state['uploaded_file_id'] = uploaded_file.file_id
         st.success("Data uploaded successfully!")
 
     if not st.session_state['dataframe'].empty:
@@ -44,65 +72,74 @@ with st.sidebar:
         st.warning("Please upload data to select columns.")
 
 
-def get_user_prompt(input_required, notes, transcript):
-    match input_required:
-        case 'notes':
-            return f'''NOTES: {notes}'''
-        case 'transcript':
-            return f'''TRANSCRIPT: {transcript}'''
-        case 'both':
-            return f'''NOTES: {notes}
-TRANSCRIPT: {transcript}'''
-
-
-def evaluate_notes(df, notes_col, transcript_col, criteria_list, model_type):
-    results = df.copy()
-
-    def process_criteria(criterion):
-        title = criterion['title']
-        response_type = criterion['type']  # 'list' or 'score'
-
-        def process_row(row):
-            notes = row[notes_col]
-            transcript = row[transcript_col]
-
-            messages = [
-                {
-                    "role": "system", "content": criterion['prompt']
-                },
-                {
-                    "role": "user", "content": get_user_prompt(criterion['input_required'], notes, transcript)
-                }
-            ]
-
-            response = generate(messages, model_type)
-
-            if response_type == 'list':
-                num_items = len([line for line in response.strip().split('\n') if line.strip()])
-                score = num_items
-            elif response_type == 'score':
-                try:
-                    score = int(re.findall(r'\d+', response)[-1])
-                except:
-                    score = None
+def evaluate_notes(df, notes_col, transcript_col, criteria_list, model_type, hedge=None, resume=True):
+    # a shallow copy: the result columns are added alongside the input's without duplicating it
+    results = df.copy(deep=False)
+
+    # every scored (row, criterion) is checkpointed, so an interrupted run only pays for what is left
+    journal = RunJournal(make_run_id("evaluate", [criterion['prompt'] for criterion in criteria_list],
+                                     model_type, notes_col, transcript_col))
+    if not resume:
+        journal.reset()
+    checkpointed = journal.completed()
+    row_keys = [make_row_key(index, notes, transcript)
+                for index, notes, transcript in zip(df.index, df[notes_col].tolist(), df[transcript_col].tolist())]
+    # every row's user message, rendered once per input format rather than once per (criterion, row)
+    user_prompts = render_evaluation_inputs(df, notes_col, transcript_col, criteria_list)
+
+    # one request per (criterion, row) still to do, all dispatched together on the async engine;
+    # a fused criterion answers all of its members in one request
+    responses = {}
+    units = []
+    requests = []
+    for criterion in criteria_list:
+        members = criterion.get('criteria', [criterion])
+        for position, user_prompt in enumerate(user_prompts[criterion['input_required']]):
+            done = [(row_keys[position], member['title'], 0) for member in members]
+            if all(unit in checkpointed for unit in done):
+                for member, unit in zip(members, done):
+                    responses[(member['title'], position)] = checkpointed[unit]
+                continue
+            units.append((criterion, position))
+            requests.append({
+                "messages": [
+                    {
+                        "role": "system", "content": criterion['prompt']
+                    },
+                    {
+                        "role": "user",
+                        "content": user_prompt
+                    }
+                ],
+                "model_type": model_type,
+                "hedge": hedge,
+                # a fused answer missing a section is retried next run rather than replayed from the cache
+                "cacheable": partial(is_complete_response, criterion)
+            })
+
+    num_failed = 0
+    for completion in iter_generate_many(requests, capture_errors=True):
+        criterion, position = units[completion.index]
+        for title, response in split_response(criterion, completion.response).items():
+            responses[(title, position)] = response
+            if isinstance(response, FailedResponse):
+                num_failed += 1
             else:
-                score = None
-
-            return score, response
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results_list = list(executor.map(process_row, [row for _, row in df.iterrows()]))
-
-        scores = [res[0] for res in results_list]
-        raw_responses = [res[1] for res in results_list]
+                journal.record(row_keys[position], response, criterion=title)
+    if not num_failed:
+        journal.finish()
+    journal.close()
+
+    criteria_list = [member for criterion in criteria_list for member in criterion.get('criteria', [criterion])]
+    criteria_results_list = []
+    for criterion in criteria_list:
+        title = criterion['title']
+        raw_responses = [responses[(title, position)] for position in range(len(df))]
+        scores = [score_response(response, criterion['type']) for response in raw_responses]
 
         results[f"{title} Score"] = scores
         results[f"{title} Response"] = raw_responses
-
-        return scores, raw_responses
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        criteria_results_list = list(executor.map(process_criteria, criteria_list))
+        criteria_results_list.append((scores, raw_responses))
 
     for i, criteria in enumerate(criteria_list):
         results[criteria['title'] + ' score'] = criteria_results_list[i][0]
@@ -114,7 +151,31 @@ def evaluate_notes(df, notes_col, transcript_col, criteria_list, model_type):
 def display_results(results_df, notes_col):
     st.write("Evaluation Results")
 
-    for idx, row in results_df.iterrows():
+    score_table = pd.DataFrame({criterion['title']: pd.to_numeric(results_df[f"{criterion['title']} Score"],
+                                                                  errors='coerce')
+                                for criterion in st.session_state['criteria']}, index=results_df.index)
+
+    # filter and sort on the score table, then render the full responses for the visible page only
+    titles = [criterion['title'] for criterion in st.session_state['criteria']]
+    filter_col, low_col, high_col, sort_col, order_col = st.columns(5)
+    filter_title = filter_col.selectbox("Filter by", [NO_FILTER] + titles)
+    low = low_col.number_input("Min score", value=None, disabled=filter_title == NO_FILTER)
+    high = high_col.number_input("Max score", value=None, disabled=filter_title == NO_FILTER)
+    sort_title = sort_col.selectbox("Sort by", [ROW_ORDER] + titles)
+    descending = order_col.checkbox("Highest first", value=True, disabled=sort_title == ROW_ORDER)
+    shown = select_rows(score_table, None if filter_title == NO_FILTER else filter_title, low, high,
+                        None if sort_title == ROW_ORDER else sort_title, descending)
+
+    st.caption(f"{len(shown)} of {len(results_df)} notes")
+    # the grid only draws the rows in view, so it can hold every selected row
+    st.dataframe(score_table.loc[shown], use_container_width=True)
+
+    size_col, page_col = st.columns(2)
+    page_size = size_col.selectbox("Notes per page", PAGE_SIZES)
+    page = page_col.number_input("Page", min_value=1, max_value=page_count(len(shown), page_size), value=1)
+
+    for idx in page_of(shown, page, page_size):
+        row = results_df.loc[idx]
         with st.expander(f"**Note {idx + 1}:**"):
             st.write(row[notes_col])
         for criterion in st.session_state['criteria']:
@@ -137,19 +198,17 @@ if not st.session_state['dataframe'].empty:
                 st.session_state['dataframe'],
                 st.session_state['notes_column'],
                 st.session_state['transcript_column'],
-                st.session_state['criteria'],
-                selected_model
+                get_criteria(fused=True) if fuse_criteria else st.session_state['criteria'],
+                selected_model,
+                HedgePolicy() if hedge_requests else None,
+                resume_runs
             )
             st.session_state['results'] = results
+            st.session_state['results_version'] = new_version()
             st.success("Evaluation complete!")
 
     if not st.session_state['results'].empty:
         display_results(st.session_state['results'], st.session_state['notes_column'])
 
-        csv = st.session_state['results'].to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="Download Results as CSV",
-            data=csv,
-            file_name="evaluation_results.csv",
-            mime="text/csv",
-        )
+        # Parquet and Arrow keep per-iteration score and response lists as list columns
+        download_table(st.session_state['results'], st.session_state['results_version'], "evaluation_results")
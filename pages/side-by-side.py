@@ -1,8 +1,11 @@
 import streamlit as st
-from services.llm_service import generate
+from helpers.format import format_stream_stats
+from services.llm_service import FailedResponse, iter_stream_many
+import numpy as np
 import pandas as pd
 import sys
 import os
+import time
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -10,6 +13,35 @@ st.set_page_config(layout="wide")
 
 st.title("Model Side-by-Side Comparison")
 
+# concurrent streams per model, so one provider's rate limit isn't hit by every iteration at once
+MAX_CONCURRENCY_PER_MODEL = 4
+# seconds between redraws of a streaming cell
+STREAM_REDRAW_INTERVAL = 0.1
+
+
+def latency_summary(cell_stats, cell_failed):
+    rows = []
+    for model, all_stats in cell_stats.items():
+        # failed cells and cells answered from the response cache end almost at once, so they are
+        # counted rather than benchmarked
+        stats_list = [stats for stats, failed in zip(all_stats, cell_failed[model]) if not failed and not stats.cached]
+        latencies = [stats.finished_at - stats.started for stats in stats_list if stats.finished_at is not None]
+        ttfts = [stats.time_to_first_token for stats in stats_list if stats.time_to_first_token is not None]
+        speeds = [stats.tokens_per_second for stats in stats_list if stats.tokens_per_second is not None]
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if latencies else (None, None, None)
+        rows.append({
+            "Model": model,
+            "p50 latency (s)": p50,
+            "p90 latency (s)": p90,
+            "p99 latency (s)": p99,
+            "Median time to first token (s)": np.median(ttfts) if ttfts else None,
+            "Median tokens/s": np.median(speeds) if speeds else None,
+            "Failed": sum(cell_failed[model]),
+            "Cached": sum(1 for stats, failed in zip(all_stats, cell_failed[model]) if stats.cached and not failed),
+        })
+    return pd.DataFrame(rows).round(2)
+
+
 with st.sidebar:
     st.header("Input Parameters")
     prompt = st.text_area(label="System Prompt")
@@ -27,35 +59,64 @@ if generate_button:
     else:
         progress_bar = st.progress(0)
 
-        results = {model: [] for model in selected_models}
+        results = {model: [None] * num_iterations for model in selected_models}
+        cell_stats = {model: [None] * num_iterations for model in selected_models}
+        cell_failed = {model: [False] * num_iterations for model in selected_models}
 
         total_iterations = len(selected_models) * num_iterations
         current_iteration = 0
 
-        for model in selected_models:
-            for i in range(num_iterations):
-                messages = [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": transcript}
-                ]
-                response = generate(messages, model_type=model)
-                results[model].append(response)
-
-                current_iteration += 1
-                progress_bar.progress(current_iteration / total_iterations)
-
         st.header("Comparison Results")
 
         tab1, tab2 = st.tabs(["Side-by-Side View", "Tabular View"])
 
         with tab1:
+            cells = [(model, i) for model in selected_models for i in range(num_iterations)]
+            placeholders = {}
+            captions = {}
             cols = st.columns(len(selected_models))
             for idx, model in enumerate(selected_models):
                 with cols[idx]:
                     st.subheader(model)
-                    for i, response in enumerate(results[model]):
+                    for i in range(num_iterations):
                         st.write(f"Iteration {i + 1}")
-                        st.text_area(f"{model} - Iteration {i + 1}", value=response, height=200, key=f"{model}_{i}")
+                        with st.container(height=200):
+                            placeholders[(model, i)] = st.empty()
+                        captions[(model, i)] = st.empty()
+
+            # every (model, iteration) cell streams at once; each fills its own slot as deltas arrive
+            requests = [
+                {
+                    "messages": [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": transcript}
+                    ],
+                    "model_type": model,
+                    "use_cache": num_iterations == 1
+                }
+                for model, i in cells
+            ]
+            texts = [""] * len(cells)
+            last_drawn = [0.0] * len(cells)
+            for event in iter_stream_many(requests, max_concurrency_per_model=MAX_CONCURRENCY_PER_MODEL,
+                                          capture_errors=True):
+                model, i = cells[event.index]
+                if isinstance(event.delta, FailedResponse):
+                    texts[event.index] = event.delta
+                else:
+                    texts[event.index] += event.delta
+                now = time.monotonic()
+                # redrawing on every token would swamp the browser with many cells streaming at once
+                if event.done or now - last_drawn[event.index] >= STREAM_REDRAW_INTERVAL:
+                    placeholders[(model, i)].markdown(texts[event.index])
+                    last_drawn[event.index] = now
+                if event.done:
+                    results[model][i] = texts[event.index]
+                    cell_stats[model][i] = event.stats
+                    cell_failed[model][i] = isinstance(texts[event.index], FailedResponse)
+                    captions[(model, i)].caption(format_stream_stats(event.stats))
+                    current_iteration += 1
+                    progress_bar.progress(current_iteration / total_iterations)
 
         with tab2:
             df_data = []
@@ -68,6 +129,9 @@ if generate_button:
             df = pd.DataFrame(df_data)
             st.dataframe(df, use_container_width=True)
 
+            st.subheader("Latency")
+            st.dataframe(latency_summary(cell_stats, cell_failed), use_container_width=True)
+
         csv = df.to_csv(index=False)
         st.download_button(
             label="Download results as CSV",
@@ -1,6 +1,7 @@
 import streamlit as st
 
-from services.llm_service import supported_models, generate
+from helpers.format import format_stream_stats
+from services.llm_service import StreamStats, stream_generate, supported_models
 
 st.set_page_config(page_title='Basic Generation', page_icon='🤖', layout='wide')
 st.title('Basic Generation')
@@ -18,7 +19,10 @@ if st.button("Generate"):
         {"role": "system", "content": system_msg},
         {"role": "user", "content": user_msg}
     ]
-    st.markdown(generate(
+    stats = StreamStats()
+    st.write_stream(stream_generate(
         messages,
-        model_type
+        model_type,
+        stats=stats
     ))
+    st.caption(format_stream_stats(stats))
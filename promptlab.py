@@ -0,0 +1,123 @@
+"""
+Headless batch runs, e.g. from cron or a batch container:
+
+    python promptlab.py run generate --input rows.csv --output out.jsonl --model gpt-4o \
+        --system-prompt-file system.txt --user-prompt "{{transcripts}}" --column summary
+    python promptlab.py run evaluate --input notes.parquet --output scores.csv --model gpt-4o \
+        --notes-column notes --transcript-column transcript
+
+Results stream to the output file as rows finish (.jsonl or .csv; .parquet and .arrow are written at the end) and
+progress goes to stderr. Runs are checkpointed like the app's, so rerunning an interrupted command resumes.
+With --shards N the rows are split across N worker processes and the output is written in row order.
+"""
+import argparse
+import os
+import sys
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="promptlab")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run a batch job without the Streamlit app")
+    tasks = run.add_subparsers(dest="task", required=True)
+
+    def common(task):
+        task.add_argument("--input", required=True, help="CSV, Parquet or Arrow table of rows")
+        task.add_argument("--output", required=True, help="results file (.jsonl, .csv, .parquet or .arrow)")
+        task.add_argument("--model", required=True, help="model type, e.g. gpt-4o")
+        task.add_argument("--concurrency", type=int,
+                          help="requests in flight (default PROMPTLAB_MAX_ASYNC_CONCURRENCY)")
+        task.add_argument("--deadline-minutes", type=float, default=0,
+                          help="give up on rows still running after this")
+        task.add_argument("--no-resume", action="store_true", help="ignore checkpoints from earlier runs")
+        task.add_argument("--shards", type=int, default=1,
+                          help="split the rows across this many worker processes")
+
+    generate = tasks.add_parser("generate", help="fill a new column from a prompt template")
+    common(generate)
+    system_prompt = generate.add_mutually_exclusive_group(required=True)
+    system_prompt.add_argument("--system-prompt")
+    system_prompt.add_argument("--system-prompt-file")
+    user_prompt = generate.add_mutually_exclusive_group(required=True)
+    user_prompt.add_argument("--user-prompt", help="template; {{column}} is replaced with the row's value")
+    user_prompt.add_argument("--user-prompt-file")
+    generate.add_argument("--column", required=True, help="name of the generated column")
+    generate.add_argument("--no-cache", action="store_true", help="resample instead of reusing cached responses")
+
+    evaluate = tasks.add_parser("evaluate", help="score notes against the evaluation criteria")
+    common(evaluate)
+    evaluate.add_argument("--notes-column", required=True)
+    evaluate.add_argument("--transcript-column", required=True)
+    evaluate.add_argument("--fused", action="store_true", help="score all criteria in one request per row")
+    return parser.parse_args(argv)
+
+
+def read_text(value, path):
+    if path is None:
+        return value
+    with open(path, encoding="utf-8") as prompt_file:
+        return prompt_file.read()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.concurrency:
+        # read once at import, so it has to be set before the services are loaded
+        os.environ["PROMPTLAB_MAX_ASYNC_CONCURRENCY"] = str(args.concurrency)
+
+    from helpers.format import format_duration
+    from services.clients import MAX_ASYNC_CONCURRENCY
+    from services.llm_service import FailedResponse
+    from prompts.templates import PromptTemplate
+    from services.runner import ResultWriter, load_table, run_evaluation, run_generation, run_sharded, table_columns
+
+    def show_progress(progress):
+        rate = (progress.completed - progress.resumed) / max(progress.elapsed, 1e-9)
+        eta = format_duration((progress.total - progress.completed) / rate) if rate else "?"
+        print(f"\r{progress.completed}/{progress.total} · {rate:.1f}/s · {progress.failed} failed · ETA {eta}   ",
+              end="", file=sys.stderr, flush=True)
+
+    options = dict(resume=not args.no_resume, deadline=args.deadline_minutes * 60 or None)
+    if args.task == "generate":
+        task_options = dict(system_prompt=read_text(args.system_prompt, args.system_prompt_file),
+                            user_prompt=read_text(args.user_prompt, args.user_prompt_file),
+                            model_type=args.model, output_column=args.column, use_cache=not args.no_cache, **options)
+    else:
+        task_options = dict(notes_column=args.notes_column, transcript_column=args.transcript_column,
+                            model_type=args.model, fused=args.fused, **options)
+    max_concurrency = args.concurrency or MAX_ASYNC_CONCURRENCY
+
+    # check the prompt's columns against the input's header before anything is sent or written
+    if args.task == "generate":
+        required = PromptTemplate(task_options["user_prompt"]).columns
+    else:
+        required = [args.notes_column, args.transcript_column]
+    available = set(table_columns(args.input))
+    missing = [column for column in required if column not in available]
+    if missing:
+        print(f"error: {args.input} has no column {', '.join(missing)}", file=sys.stderr)
+        return 2
+
+    if args.shards > 1:
+        failed = run_sharded(args.task, args.input, args.output, args.shards, max_concurrency, show_progress,
+                             **task_options)
+    else:
+        df = load_table(args.input)
+        run = run_generation if args.task == "generate" else run_evaluation
+        writer = ResultWriter(args.output, df)
+        failed = 0
+        try:
+            for result in run(df, max_concurrency=max_concurrency, on_progress=show_progress, **task_options):
+                writer.write(result)
+                failed += isinstance(result.response, FailedResponse)
+        finally:
+            writer.close()
+    print(file=sys.stderr)
+    if failed:
+        print(f"{failed} results failed; see the 'failed' field in {args.output}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,14 @@ How it works
 'list' implies we count the number of items in the response
 'score' implies we let the LLM just provide its own score
 """
+import re
+from typing import Dict, List
+
+import pandas as pd
+
+from helpers.format import extract_tags
+from prompts.templates import PromptTemplate
+from services.llm_service import FailedResponse
 
 # 'notes', 'transcript', or 'both'
 CRITERIA = [
@@ -69,8 +77,50 @@ def decorate_criteria_prompts(criteria):
         '''
 
 
-def get_criteria():
-    return [
+def fuse_criteria_prompts(criteria_list):
+    tasks = "\n\n".join(
+        f'''TASK {criteria['title']}:
+{criteria['prompt']}
+Write your answer to this task, and nothing else, between <{criteria['title']}> and </{criteria['title']}>'''
+        for criteria in criteria_list
+    )
+    return f'''You will complete {len(criteria_list)} independent evaluation tasks on the same input. Do each task on its own, as if the others did not exist, and output nothing outside the task tags.
+
+{tasks}
+'''
+
+
+# the user message for each 'input_required'; {{notes}} and {{transcript}} are the selected columns
+EVALUATION_INPUTS = {
+    'notes': 'NOTES: {{notes}}',
+    'transcript': 'TRANSCRIPT: {{transcript}}',
+    'both': 'NOTES: {{notes}}\nTRANSCRIPT: {{transcript}}',
+}
+
+
+def render_evaluation_inputs(df: pd.DataFrame, notes_column: str, transcript_column: str,
+                             criteria_list) -> Dict[str, List[str]]:
+    """Every row's user message for each 'input_required' the criteria use, rendered a column at a time."""
+    columns = {'notes': notes_column, 'transcript': transcript_column}
+    return {
+        input_required: PromptTemplate(EVALUATION_INPUTS.get(input_required, '')).render_all(df, columns)
+        for input_required in {criteria['input_required'] for criteria in criteria_list}
+    }
+
+
+def fused_input_required(criteria_list):
+    inputs = {criteria['input_required'] for criteria in criteria_list}
+    return inputs.pop() if len(inputs) == 1 else 'both'
+
+
+def get_criteria(fused=False):
+    """
+    The evaluation criteria with their decorated prompts. With `fused`, every criterion is folded into a
+    single 'fused' criterion whose prompt asks for all of them at once, each answer in its own tags, so a
+    row is sent once instead of once per criterion; `split_fused_response` recovers the per-criterion
+    answers. Its members are in `criteria`.
+    """
+    criteria_list = [
         {
             'title': criteria['title'],
             'prompt': decorate_criteria_prompts(criteria),
@@ -79,3 +129,60 @@ def get_criteria():
         }
         for criteria in CRITERIA
     ]
+    if not fused or len(criteria_list) < 2:
+        return criteria_list
+    return [
+        {
+            'title': '+'.join(criteria['title'] for criteria in criteria_list),
+            'prompt': fuse_criteria_prompts(criteria_list),
+            'type': 'fused',
+            'input_required': fused_input_required(criteria_list),
+            'criteria': criteria_list
+        }
+    ]
+
+
+def split_fused_response(fused_criteria, response):
+    """Map each member title of a fused criterion to its answer in `response`, or None if it is missing."""
+    return {
+        criteria['title']: extract_tags(response, f"<{re.escape(criteria['title'])}>",
+                                        f"</{re.escape(criteria['title'])}>")
+        for criteria in fused_criteria['criteria']
+    }
+
+
+def is_complete_response(criterion, response) -> bool:
+    """False for a fused response missing any member's section, which shouldn't be cached or reused."""
+    if 'criteria' not in criterion:
+        return True
+    return all(section is not None for section in split_fused_response(criterion, response).values())
+
+
+def split_response(criterion, response):
+    """
+    Per-member responses for one request: `{title: response}` for a single criterion, every member's
+    section of a fused one. A missing section, or the whole request failing, becomes a FailedResponse.
+    """
+    if 'criteria' not in criterion:
+        return {criterion['title']: response}
+    if isinstance(response, FailedResponse):
+        return {member['title']: response for member in criterion['criteria']}
+    return {
+        title: FailedResponse.from_exception(ValueError(f"no <{title}> section in the fused response"))
+        if section is None else section
+        for title, section in split_fused_response(criterion, response).items()
+    }
+
+
+def score_response(response, response_type):
+    """The number of items in a 'list' response or the last number in a 'score' one; None if there is none."""
+    if isinstance(response, FailedResponse):
+        return None
+    elif response_type == 'list':
+        return len([line for line in response.strip().split('\n') if line.strip()])
+    elif response_type == 'score':
+        try:
+            return int(re.findall(r'\d+', response)[-1])
+        except (IndexError, ValueError):
+            return None
+    return None
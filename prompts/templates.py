@@ -0,0 +1,70 @@
+import itertools
+import re
+from typing import Any, Iterable, List, Mapping, Optional
+
+import pandas as pd
+
+PLACEHOLDER = re.compile(r"{{([a-zA-Z_\s]*)}}")
+
+
+class UnknownColumnError(ValueError):
+    pass
+
+
+class PromptTemplate:
+    """
+    A prompt with `{{column}}` placeholders, parsed once into its literal text and the columns between
+    them. `render_all` fills it for a whole table a column at a time rather than a row at a time.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        pieces = PLACEHOLDER.split(source)
+        self.literals = pieces[0::2]  # always one more than placeholders
+        self.placeholders = pieces[1::2]
+
+    @property
+    def columns(self) -> List[str]:
+        """The distinct columns the template refers to, in order of first use."""
+        return list(dict.fromkeys(self.placeholders))
+
+    def missing(self, columns: Iterable[str]) -> List[str]:
+        available = set(columns)
+        return [column for column in self.columns if column not in available]
+
+    def validate(self, columns: Iterable[str]):
+        missing = self.missing(columns)
+        if missing:
+            raise _unknown_columns(missing)
+
+    def render(self, row: Mapping[str, Any]) -> str:
+        """Fill the template from one row, leaving placeholders for columns the row doesn't have as they are."""
+        parts = [self.literals[0]]
+        for column, literal in zip(self.placeholders, self.literals[1:]):
+            parts.append(str(row[column]) if column in row else "{{" + column + "}}")
+            parts.append(literal)
+        return "".join(parts)
+
+    def render_all(self, df: pd.DataFrame, columns: Optional[Mapping[str, str]] = None) -> List[str]:
+        """
+        The filled template for every row of `df`, in row order. `columns` maps placeholder names to the
+        dataframe's columns where they differ. Raises UnknownColumnError before rendering anything if a
+        placeholder has no column.
+        """
+        columns = columns or {}
+        missing = [columns.get(column, column) for column in self.columns if columns.get(column, column) not in df]
+        if missing:
+            raise _unknown_columns(missing)
+        # each column is converted to strings once, then every row is one join over the pieces
+        values = {column: list(map(str, df[columns.get(column, column)].tolist())) for column in self.columns}
+        if not self.placeholders:
+            return [self.source] * len(df)
+        pieces = [itertools.repeat(self.literals[0])]
+        for column, literal in zip(self.placeholders, self.literals[1:]):
+            pieces.append(values[column])
+            pieces.append(itertools.repeat(literal))
+        return ["".join(row) for row in zip(*pieces)]
+
+
+def _unknown_columns(missing: List[str]) -> UnknownColumnError:
+    return UnknownColumnError(f"Unknown column{'s' if len(missing) > 1 else ''} in prompt: {', '.join(missing)}")
@@ -1 +1 @@
-from .llm_service import generate
+from .llm_service import generate, agenerate, generate_many
@@ -0,0 +1,141 @@
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+from .journal import JOURNAL_DIR, batch_record_path
+from .llm_service import FailedResponse, _build_request, get_openai_api_key
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+POLL_INTERVAL = float(os.getenv("PROMPTLAB_BATCH_POLL_INTERVAL", "30"))
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchError(RuntimeError):
+    pass
+
+
+class HttpBatchTransport:
+    """
+    Talks to an OpenAI-compatible `/files` + `/batches` API. Any object with the same four methods can
+    stand in for it, e.g. to run against a local fake batch server or an in-memory stub.
+    """
+
+    def __init__(self, base_url: Optional[str] = None, api_key: Optional[str] = None,
+                 http_client: Optional[httpx.Client] = None):
+        base_url = base_url or os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+        self._client = http_client or httpx.Client(timeout=httpx.Timeout(600.0, connect=10.0))
+        self._base_url = base_url.rstrip("/")
+        self._headers = {"Authorization": f"Bearer {api_key or get_openai_api_key()}"}
+
+    def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        response = self._client.request(method, self._base_url + path, headers=self._headers, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def upload(self, content: bytes) -> str:
+        files = {"file": ("batch.jsonl", content, "application/jsonl")}
+        return self._request("POST", "/files", data={"purpose": "batch"}, files=files).json()["id"]
+
+    def create(self, input_file_id: str, endpoint: str, completion_window: str) -> Dict[str, Any]:
+        body = {"input_file_id": input_file_id, "endpoint": endpoint, "completion_window": completion_window}
+        return self._request("POST", "/batches", json=body).json()
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        return self._request("GET", f"/batches/{batch_id}").json()
+
+    def download(self, file_id: str) -> bytes:
+        return self._request("GET", f"/files/{file_id}/content").content
+
+
+def supports_batch(model_type: str) -> bool:
+    # the models _build_request sends to OpenAI; Azure and Bedrock have no batch endpoint here
+    return model_type in ["gpt-4", "gpt-4-o1-preview", "gpt-4o"]
+
+
+def build_batch_file(requests: List[Dict[str, Any]], custom_ids: List[str]) -> bytes:
+    """Serialize `generate`-style requests into the provider's JSONL batch input, one line per custom id."""
+    lines = []
+    for custom_id, request in zip(custom_ids, requests):
+        provider, _, params = _build_request(request["messages"], request.get("model_type", "gpt-4"))
+        if provider != "openai":
+            raise ValueError(f"Batch mode is only available for OpenAI models, not {request.get('model_type')}")
+        lines.append(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": params},
+                                ensure_ascii=False))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def submit_batch(requests: List[Dict[str, Any]], custom_ids: List[str], transport=None) -> str:
+    transport = transport or HttpBatchTransport()
+    input_file_id = transport.upload(build_batch_file(requests, custom_ids))
+    return transport.create(input_file_id, BATCH_ENDPOINT, COMPLETION_WINDOW)["id"]
+
+
+def wait_for_batch(batch_id: str, transport=None, poll_interval: float = POLL_INTERVAL,
+                   on_status: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """Poll until the batch reaches a terminal status, calling `on_status` with every update."""
+    transport = transport or HttpBatchTransport()
+    while True:
+        batch = transport.retrieve(batch_id)
+        if on_status is not None:
+            on_status(batch)
+        if batch["status"] in TERMINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+def fetch_results(batch: Dict[str, Any], transport=None) -> Dict[str, str]:
+    """
+    Responses of a finished batch keyed by custom id. Requests that errored come back as
+    `FailedResponse`; requests the batch never ran (it expired or was cancelled) are missing.
+    """
+    transport = transport or HttpBatchTransport()
+    results = {}
+    for file_id in (batch.get("error_file_id"), batch.get("output_file_id")):
+        if not file_id:
+            continue
+        for line in transport.download(file_id).decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            results[entry["custom_id"]] = _parse_entry(entry)
+    if not results and batch["status"] == "failed":
+        errors = (batch.get("errors") or {}).get("data") or []
+        raise BatchError("; ".join(error.get("message", "") for error in errors) or f"Batch {batch['id']} failed")
+    return results
+
+
+def _parse_entry(entry: Dict[str, Any]) -> str:
+    response = entry.get("response") or {}
+    if entry.get("error") or response.get("status_code") != 200:
+        error = entry.get("error") or response.get("body", {}).get("error") or {}
+        message = error.get("message", "") if isinstance(error, dict) else str(error)
+        return FailedResponse.from_exception(BatchError(message or f"status {response.get('status_code')}"))
+    return response["body"]["choices"][0]["message"]["content"]
+
+
+def _pending_path(run_id: str) -> str:
+    return batch_record_path(run_id)
+
+
+def pending_batch(run_id: str) -> Optional[str]:
+    """The batch already submitted for `run_id` and not yet merged, so a restarted app re-attaches to it."""
+    try:
+        with open(_pending_path(run_id), encoding="utf-8") as pending:
+            return json.load(pending)["batch_id"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def remember_batch(run_id: str, batch_id: str):
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    with open(_pending_path(run_id), "w", encoding="utf-8") as pending:
+        json.dump({"batch_id": batch_id, "submitted_at": time.time()}, pending)
+
+
+def forget_batch(run_id: str):
+    if os.path.exists(_pending_path(run_id)):
+        os.remove(_pending_path(run_id))
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from . import metrics
+
+CACHE_ENABLED = os.getenv("PROMPTLAB_CACHE", "1") != "0"
+CACHE_PATH = os.getenv("PROMPTLAB_CACHE_PATH", os.path.join(".promptlab_cache", "responses.sqlite"))
+CACHE_TTL = float(os.getenv("PROMPTLAB_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_BYTES = int(os.getenv("PROMPTLAB_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+'''
+
+
+def cache_key(provider: str, params: Dict[str, Any], endpoint: Optional[Dict[str, Any]] = None) -> str:
+    """Hash of the normalized request: the provider and endpoint plus the exact create() params sent to it."""
+    payload = json.dumps({"provider": provider, "endpoint": endpoint or {}, "params": params},
+                         sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response store with a TTL and least-recently-used eviction once the stored
+    responses exceed `max_bytes`. Safe to share between threads; WAL mode lets several processes
+    read and write the same file.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._size = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                metrics.increment("cache.misses")
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        metrics.increment("cache.hits")
+        return row[0]
+
+    def set(self, key: str, response: str):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        # other processes may share the file, so re-read the real size before trimming
+        self._size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if self._size <= self.max_bytes:
+            return
+
+        # trim to 90% so we are not evicting again on the very next write
+        target = int(self.max_bytes * 0.9)
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        metrics.increment("cache.evictions", len(evicted))
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute("DELETE FROM responses")
+            self._size = 0
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[ResponseCache]:
+    """The process-wide cache, or None when disabled with PROMPTLAB_CACHE=0."""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+    return _cache
+
+
+def cache_stats() -> Dict[str, float]:
+    counters = metrics.snapshot()
+    return {name: counters.get(f"cache.{name}", 0) for name in ("hits", "misses", "evictions")}
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Dict, Tuple, Union
+
+import httpx
+
+# Upper bound on in-flight requests per process. The worker pools in the pages are sized to this,
+# and each pooled client keeps this many keep-alive connections so no worker waits on the pool.
+MAX_CONCURRENCY = int(os.getenv("PROMPTLAB_MAX_CONCURRENCY", "32"))
+# In-flight requests on the asyncio engine. Coroutines are cheap, so this can sit far above the thread limit.
+MAX_ASYNC_CONCURRENCY = int(os.getenv("PROMPTLAB_MAX_ASYNC_CONCURRENCY", "256"))
+KEEPALIVE_EXPIRY = float(os.getenv("PROMPTLAB_KEEPALIVE_EXPIRY", "120"))
+
+_clients: Dict[Tuple, Any] = {}
+# async clients hold connections bound to the loop that opened them, so they are cached per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, Any]]" = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+HttpClient = Union[httpx.Client, httpx.AsyncClient]
+
+
+# SDK retries are off (max_retries=0): retries, backoff and deadlines are handled in services/retry.py.
+def _openai(http_client: HttpClient, **config):
+    from openai import AsyncOpenAI, OpenAI
+    cls = AsyncOpenAI if isinstance(http_client, httpx.AsyncClient) else OpenAI
+    return cls(http_client=http_client, max_retries=0, **config)
+
+
+def _azure_openai(http_client: HttpClient, **config):
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+    cls = AsyncAzureOpenAI if isinstance(http_client, httpx.AsyncClient) else AzureOpenAI
+    return cls(http_client=http_client, max_retries=0, **config)
+
+
+def _anthropic_bedrock(http_client: HttpClient, **config):
+    from anthropic import AnthropicBedrock, AsyncAnthropicBedrock
+    cls = AsyncAnthropicBedrock if isinstance(http_client, httpx.AsyncClient) else AnthropicBedrock
+    return cls(http_client=http_client, max_retries=0, **config)
+
+
+_FACTORIES = {
+    "openai": _openai,
+    "azure_openai": _azure_openai,
+    "anthropic_bedrock": _anthropic_bedrock,
+}
+
+
+def _limits(pool_size: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _http_client() -> httpx.Client:
+    return httpx.Client(
+        limits=_limits(MAX_CONCURRENCY),
+        timeout=httpx.Timeout(600.0, connect=10.0),
+        follow_redirects=True,
+    )
+
+
+def _async_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=_limits(MAX_ASYNC_CONCURRENCY),
+        timeout=httpx.Timeout(600.0, connect=10.0),
+        follow_redirects=True,
+    )
+
+
+def _client_key(provider: str, config: Dict[str, Any]) -> Tuple:
+    if provider not in _FACTORIES:
+        raise ValueError(f"Invalid provider: {provider}")
+    return (provider,) + tuple(sorted(config.items()))
+
+
+def get_client(provider: str, **config):
+    """
+    Return the process-wide client for `provider` built with `config` (credentials, api version, ...).
+    Clients are created once per distinct config and shared across threads, so every call reuses the
+    same keep-alive connection pool instead of paying for a new TLS handshake.
+    """
+    key = _client_key(provider, config)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _FACTORIES[provider](_http_client(), **config)
+                _clients[key] = client
+    return client
+
+
+def get_async_client(provider: str, **config):
+    """
+    Async counterpart of `get_client`. Must be called from a running event loop; the client is shared
+    by every coroutine on that loop.
+    """
+    key = _client_key(provider, config)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            client = _FACTORIES[provider](_async_http_client(), **config)
+            loop_clients[key] = client
+    return client
+
+
+def close_clients():
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
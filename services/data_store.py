@@ -0,0 +1,166 @@
+import os
+import threading
+import uuid
+import weakref
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Union
+
+import pandas as pd
+import pyarrow as pa
+
+from helpers.io import arrow_array
+
+# how many earlier versions a session keeps for undo, and the memory they may hold between them
+MAX_HISTORY = int(os.getenv("PROMPTLAB_UNDO_HISTORY", "10"))
+MAX_SESSION_BYTES = int(float(os.getenv("PROMPTLAB_MAX_SESSION_MB", "2048")) * 1024 * 1024)
+
+
+class Snapshot(NamedTuple):
+    version: str
+    label: str  # what produced this version, e.g. "Upload" or "Generate summary"
+    columns: Dict[str, pa.ChunkedArray]  # in column order
+    num_rows: int
+
+
+class DataStore:
+    """
+    One session's table as immutable Arrow columns. Every change makes a new snapshot that shares all
+    the columns it didn't touch with the previous one: a generated column is appended as its own
+    array and uploaded transcripts are held once however many runs use them. Snapshots are what undo
+    goes back to; old ones are dropped past `max_history` or once the session holds more than
+    `max_bytes`.
+
+    `frame()` is a pandas view over the current snapshot (ArrowDtype columns, no copy), so `df.copy()`
+    on it is cheap too.
+    """
+
+    def __init__(self, max_history: int = MAX_HISTORY, max_bytes: int = MAX_SESSION_BYTES):
+        self.max_history = max_history
+        self.max_bytes = max_bytes
+        self._history: List[Snapshot] = [Snapshot(_new_version(), "Empty", {}, 0)]
+        self._frame: Optional[pd.DataFrame] = None
+        self._frame_version: Optional[str] = None
+        self._lock = threading.Lock()
+        _stores.add(self)
+
+    @property
+    def current(self) -> Snapshot:
+        return self._history[-1]
+
+    @property
+    def version(self) -> str:
+        return self.current.version
+
+    def frame(self) -> pd.DataFrame:
+        """The current snapshot as a DataFrame, built once per version."""
+        with self._lock:
+            snapshot = self.current
+            if self._frame_version != snapshot.version:
+                if snapshot.columns:
+                    self._frame = pa.table(snapshot.columns).to_pandas(types_mapper=pd.ArrowDtype)
+                else:
+                    self._frame = pd.DataFrame()
+                self._frame_version = snapshot.version
+            return self._frame
+
+    def load(self, df: pd.DataFrame, label: str = "Upload") -> Snapshot:
+        """Replace the whole table, e.g. with a fresh upload."""
+        columns = {str(column): _chunked(df[column]) for column in df.columns}
+        return self._push(label, columns, len(df))
+
+    def with_column(self, name: str, values: Union[pd.Series, Sequence[Any]],
+                    label: Optional[str] = None) -> Snapshot:
+        """Add or replace one column; every other column is shared with the previous version."""
+        snapshot = self.current
+        if snapshot.columns and len(values) != snapshot.num_rows:
+            raise ValueError(f"Column {name!r} has {len(values)} values for {snapshot.num_rows} rows")
+        columns = dict(snapshot.columns)
+        columns[name] = _chunked(values)
+        return self._push(label or f"Set {name}", columns, len(values))
+
+    def append_rows(self, df: pd.DataFrame, label: str = "Add rows") -> Snapshot:
+        """Append rows as new chunks of the existing columns; columns missing from `df` are null in them."""
+        snapshot = self.current
+        if not snapshot.columns:
+            return self.load(df, label)
+        new_columns = [str(column) for column in df.columns if str(column) not in snapshot.columns]
+        columns = {}
+        for name in list(snapshot.columns) + new_columns:
+            existing = snapshot.columns.get(name)
+            if existing is None:
+                existing = pa.chunked_array([pa.nulls(snapshot.num_rows)])
+            added = _chunked(df[name]) if name in df.columns else pa.chunked_array([pa.nulls(len(df))])
+            columns[name] = _concat(existing, added)
+        return self._push(label, columns, snapshot.num_rows + len(df))
+
+    def undo(self) -> bool:
+        """Go back to the previous version; False if there is none left."""
+        with self._lock:
+            if len(self._history) < 2:
+                return False
+            self._history.pop()
+            return True
+
+    @property
+    def history(self) -> List[str]:
+        """Labels of the retained versions, oldest first."""
+        return [snapshot.label for snapshot in self._history]
+
+    def nbytes(self) -> int:
+        """Memory held by every retained version, counting buffers shared between versions once."""
+        with self._lock:
+            return _nbytes(self._history)
+
+    def _push(self, label: str, columns: Dict[str, pa.ChunkedArray], num_rows: int) -> Snapshot:
+        snapshot = Snapshot(_new_version(), label, columns, num_rows)
+        with self._lock:
+            self._history.append(snapshot)
+            while len(self._history) > 1 and (len(self._history) > self.max_history + 1
+                                              or _nbytes(self._history) > self.max_bytes):
+                self._history.pop(0)
+        return snapshot
+
+
+def _new_version() -> str:
+    return uuid.uuid4().hex
+
+
+def _chunked(values: Union[pd.Series, Sequence[Any]]) -> pa.ChunkedArray:
+    if isinstance(values, pd.Series) and isinstance(values.dtype, pd.ArrowDtype):
+        # already Arrow-backed (e.g. a column of `frame()`): keep its chunks rather than copying them
+        array = values.array.__arrow_array__()
+    else:
+        array = arrow_array(values)
+    return array if isinstance(array, pa.ChunkedArray) else pa.chunked_array([array])
+
+
+def _concat(existing: pa.ChunkedArray, added: pa.ChunkedArray) -> pa.ChunkedArray:
+    if added.type != existing.type:
+        try:
+            added = added.cast(existing.type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            if existing.type != pa.null():
+                # the types can't be reconciled, so fall back to letting Arrow infer one for the whole column
+                return _chunked(existing.to_pylist() + added.to_pylist())
+            existing = existing.cast(added.type)
+    return pa.chunked_array(existing.chunks + added.chunks, type=existing.type)
+
+
+def _nbytes(snapshots: Sequence[Snapshot]) -> int:
+    seen = set()
+    total = 0
+    for snapshot in snapshots:
+        for column in snapshot.columns.values():
+            for chunk in column.chunks:
+                for buffer in chunk.buffers():
+                    if buffer is not None and buffer.address not in seen:
+                        seen.add(buffer.address)
+                        total += buffer.size
+    return total
+
+
+_stores: "weakref.WeakSet[DataStore]" = weakref.WeakSet()
+
+
+def total_nbytes() -> int:
+    """Memory held by the data stores of every live session in this process."""
+    return sum(store.nbytes() for store in list(_stores))
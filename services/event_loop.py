@@ -0,0 +1,65 @@
+import asyncio
+import queue
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop behind the sync bridge. It runs forever on a daemon thread so async clients and
+    their connection pools survive across Streamlit reruns instead of dying with a per-call loop.
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="promptlab-event-loop", daemon=True).start()
+    return _loop
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """Run `coro` on the background loop and block the calling thread until it finishes."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result()
+    except BaseException:
+        # the caller went away (error, Ctrl-C, Streamlit stop) - don't leave the work running
+        future.cancel()
+        raise
+
+
+_DONE = object()
+
+
+def iterate_sync(items: AsyncIterator[T]) -> Iterator[T]:
+    """
+    Drive an async iterator on the background loop and yield its items in the calling thread as they
+    arrive. Closing the returned iterator early cancels the async side.
+    """
+    handoff: "queue.Queue" = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in items:
+                handoff.put((item, None))
+        except BaseException as exc:
+            handoff.put((_DONE, exc))
+            raise
+        handoff.put((_DONE, None))
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_loop())
+    try:
+        while True:
+            item, error = handoff.get()
+            if item is _DONE:
+                if error is not None and not isinstance(error, asyncio.CancelledError):
+                    raise error
+                return
+            yield item
+    finally:
+        future.cancel()
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+LATENCY_WINDOW = 500
+# no hedging until a model has this many observed calls, otherwise the percentile is noise
+MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """Rolling window of recent end-to-end call latencies per model type."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def observe(self, model_type: str, seconds: float):
+        with self._lock:
+            self._samples[model_type].append(seconds)
+
+    def percentile(self, model_type: str, percentile: float, min_samples: int = MIN_SAMPLES) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples[model_type])
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+latency_tracker = LatencyTracker()
+
+
+class HedgePolicy:
+    """
+    Opt-in tail-latency hedging: once a call has run longer than `percentile` of recent calls to the
+    same model, a duplicate is sent (to `fallback_model` if given) and whichever finishes first wins.
+    """
+
+    def __init__(self, percentile: float = 95.0, fallback_model: Optional[str] = None,
+                 min_samples: int = MIN_SAMPLES):
+        self.percentile = percentile
+        self.fallback_model = fallback_model
+        self.min_samples = min_samples
+
+    def delay(self, model_type: str) -> Optional[float]:
+        return latency_tracker.percentile(model_type, self.percentile, self.min_samples)
+
+
+async def run_hedged(primary: Callable[[], Awaitable[T]], backup: Callable[[], Awaitable[T]],
+                     delay: Optional[float]) -> Tuple[T, bool]:
+    """
+    Await `primary`; if it has not finished after `delay` seconds, start `backup` as well and return
+    the first successful result, with whether it came from `primary`. The loser is cancelled. If both
+    fail, the primary's error is raised.
+    """
+    first = asyncio.ensure_future(primary())
+    if delay is None:
+        return await first, True
+
+    second = None
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result(), True
+
+        metrics.increment("hedge.fired")
+        second = asyncio.ensure_future(backup())
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    if task is second:
+                        metrics.increment("hedge.won")
+                    return task.result(), task is first
+        return first.result(), True
+    finally:
+        for task in (first, second):
+            if task is not None and not task.done():
+                task.cancel()
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import IO, Any, Dict, Optional, Tuple
+
+JOURNAL_DIR = os.getenv("PROMPTLAB_JOURNAL_DIR", ".promptlab_runs")
+# checkpoints of runs that were never finished are dropped once they haven't been written for this long
+JOURNAL_TTL = float(os.getenv("PROMPTLAB_JOURNAL_TTL_DAYS", "7")) * 24 * 60 * 60
+
+UnitKey = Tuple[str, str, int]  # (row key, criterion, iteration)
+
+
+def _digest(*parts: Any) -> str:
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def batch_record_path(run_id: str, directory: str = JOURNAL_DIR) -> str:
+    """Where `services.batch_api` remembers the offline batch submitted for a run until its results are merged."""
+    return os.path.join(directory, f"{run_id}.batch.json")
+
+
+def make_run_id(*parts: Any) -> str:
+    """Deterministic id for a run from everything that defines it (prompts, model, columns, ...)."""
+    return _digest(*parts)[:16]
+
+
+def make_row_key(index: Any, *content: Any) -> str:
+    """Row key from its dataframe index plus a digest of its inputs, so a different file can't match."""
+    return f"{index}:{_digest(*content)[:12]}"
+
+
+class RunJournal:
+    """
+    Append-only JSONL checkpoint of completed units for one run, under `.promptlab_runs/<run_id>.jsonl`.
+    Every line is flushed as it is written, so a crash loses at most the unit in flight, and a torn
+    final line is ignored on read. A run that ends with nothing left to do calls `finish()`, so only
+    interrupted or partly failed runs are ever resumed.
+    """
+
+    def __init__(self, run_id: str, directory: str = JOURNAL_DIR):
+        self.run_id = run_id
+        self.path = os.path.join(directory, f"{run_id}.jsonl")
+        self.batch_path = batch_record_path(run_id, directory)
+        self._file: Optional[IO[str]] = None
+        self._lock = threading.Lock()
+        prune_journals(directory)
+
+    def completed(self) -> Dict[UnitKey, str]:
+        units = {}
+        if not os.path.exists(self.path):
+            return units
+        with open(self.path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                units[(entry["row_key"], entry["criterion"], entry["iteration"])] = entry["response"]
+        return units
+
+    def record(self, row_key: str, response: str, criterion: str = "", iteration: int = 0):
+        line = json.dumps({
+            "run_id": self.run_id,
+            "row_key": row_key,
+            "criterion": criterion,
+            "iteration": iteration,
+            "response": response,
+            "completed_at": time.time(),
+        }, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def reset(self):
+        """Forget every completed unit, and any offline batch still pending, so the run starts from scratch."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            for path in (self.path, self.batch_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def finish(self):
+        """The run completed every unit: drop its checkpoint so the same run started again is sent afresh."""
+        self.reset()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def prune_journals(directory: str = JOURNAL_DIR, max_age: float = JOURNAL_TTL):
+    """Delete checkpoints and pending-batch records not written to for `max_age` seconds."""
+    if not os.path.isdir(directory):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.endswith((".jsonl", ".batch.json")) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # another session may have removed it first
+            continue
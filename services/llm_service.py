@@ -1,93 +1,655 @@
+import asyncio
+import json
+import math
 import os
-from typing import List, Dict, Literal
+import time
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Literal, NamedTuple,
+                    Optional, Tuple)
 from dotenv import load_dotenv
 import streamlit as st
 
+from . import metrics
+from .cache import cache_key, get_cache
+from .clients import MAX_ASYNC_CONCURRENCY, get_async_client, get_client
+from .event_loop import iterate_sync, run_sync
+from .hedging import HedgePolicy, latency_tracker, run_hedged
+from .rate_limit import CHARS_PER_TOKEN, estimate_tokens, get_concurrency_controller, get_rate_limiter, is_throttled
+from .retry import REQUEST_TIMEOUT, Deadline, acall_with_retry, call_with_retry
+from .scheduler import FairScheduler, batch_slot
+
 load_dotenv()
 
 supported_models = Literal[
     "gpt-4o", "gpt-4-o1-preview", "gpt-4", "anthropic", "llama3 (not supported yet)"]
 
+# Mark stable prompt prefixes (the system prompt, and the first block of a message whose content is a list
+# of text blocks) as cacheable on Anthropic. OpenAI caches long prefixes automatically. Off unless
+# PROMPTLAB_PROMPT_CACHING=1: the markup and beta header are the first-party API's, and the Bedrock models
+# this app calls may reject `cache_control` outright, which would fail every row with a long system prompt.
+PROMPT_CACHING = os.getenv("PROMPTLAB_PROMPT_CACHING", "0") == "1"
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+# prefixes shorter than this are never cached, so a breakpoint on them is wasted
+MIN_CACHEABLE_TOKENS = 1024
+MAX_CACHE_BREAKPOINTS = 4
+
 
 def get_openai_api_key():
     # if on streamlit cloud
     # if 'STREAMLIT_SHARING_MODE' in os.environ:
-    return st.secrets["openapi_key"]
-    # if on local or app runner
-    # else:
-    # return os.environ.get("OPENAI_API_KEY")
+    try:
+        return st.secrets["openapi_key"]
+    except (FileNotFoundError, KeyError):
+        # headless runs (promptlab.py) have no Streamlit secrets file
+        return os.environ.get("OPENAI_API_KEY")
+
+
+class FailedResponse(str):
+    """
+    Stands in for a response that could not be generated, so one bad row doesn't sink a batch.
+    It reads as the error message wherever a response would be shown; the exception is on `.error`.
+    """
+
+    def __new__(cls, message: str, error: Optional[BaseException] = None):
+        failed = super().__new__(cls, message)
+        failed.error = error
+        return failed
+
+    @classmethod
+    def from_exception(cls, error: BaseException) -> "FailedResponse":
+        detail = f": {error}" if str(error) else ""
+        return cls(f"[generation failed] {type(error).__name__}{detail}", error)
+
+
+def generate(messages: List[Dict[str, str]], model_type: supported_models = "gpt-4", use_cache: bool = True,
+             timeout: float = REQUEST_TIMEOUT, deadline: Optional[Deadline] = None) -> str:
+    """
+    Pass `use_cache=False` when deliberately sampling the same request several times; otherwise an
+    identical earlier request is answered from the on-disk response cache. Transient failures are
+    retried with backoff; each attempt is limited to `timeout` seconds and the whole call to `deadline`.
+    """
+    provider, config, params = _build_request(messages, model_type)
+    cache, key = _lookup_cache(provider, config, params, use_cache)
+    if key is not None and (cached := cache.get(key)) is not None:
+        return cached
+
+    started = time.monotonic()
+    raw = call_with_retry(lambda: _create(provider, config, params, timeout, deadline), deadline=deadline)
+    latency_tracker.observe(model_type, time.monotonic() - started)
+    response = _parse_choices(provider, raw)[0]
+    if key is not None:
+        cache.set(key, response)
+    return response
+
+
+class StreamStats:
+    """Timing of a streamed response, filled in while the stream is consumed."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.output_tokens = 0
+        self.cached = False
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        return None if self.first_token_at is None else self.first_token_at - self.started
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.first_token_at is None or self.finished_at is None or self.finished_at <= self.first_token_at:
+            return None
+        return self.output_tokens / (self.finished_at - self.first_token_at)
+
+
+def stream_generate(messages: List[Dict[str, str]], model_type: supported_models = "gpt-4", use_cache: bool = True,
+                    timeout: float = REQUEST_TIMEOUT, stats: Optional[StreamStats] = None) -> Iterator[str]:
+    """
+    Like `generate`, but yields the response text piece by piece as the model writes it, e.g. for
+    `st.write_stream`. Pass a `StreamStats` to read time-to-first-token and tokens/sec afterwards.
+    Failures are retried only while opening the stream; an error part-way through propagates.
+    """
+    stats = stats if stats is not None else StreamStats()
+    provider, config, params = _build_request(messages, model_type)
+    cache, key = _lookup_cache(provider, config, params, use_cache)
+    if key is not None and (cached := cache.get(key)) is not None:
+        stats.first_token_at = stats.finished_at = time.monotonic()
+        stats.cached = True
+        yield cached
+        return
+
+    stream = call_with_retry(lambda: _create(provider, config, _stream_params(provider, params), timeout, None))
+    parts = []
+    try:
+        for event in stream:
+            text = _read_stream_event(provider, event, stats)
+            if text:
+                parts.append(text)
+                yield text
+    finally:
+        stream.close()
+    _finish_stream(model_type, stats, parts, cache, key)
+
+
+async def astream_generate(messages: List[Dict[str, str]], model_type: supported_models = "gpt-4",
+                           use_cache: bool = True, timeout: float = REQUEST_TIMEOUT,
+                           stats: Optional[StreamStats] = None) -> AsyncIterator[str]:
+    """Async counterpart of `stream_generate`."""
+    stats = stats if stats is not None else StreamStats()
+    provider, config, params = _build_request(messages, model_type)
+    cache, key = _lookup_cache(provider, config, params, use_cache)
+    if key is not None and (cached := cache.get(key)) is not None:
+        stats.first_token_at = stats.finished_at = time.monotonic()
+        stats.cached = True
+        yield cached
+        return
+
+    stream = await acall_with_retry(lambda: _acreate(provider, config, _stream_params(provider, params), timeout, None))
+    parts = []
+    try:
+        async for event in stream:
+            text = _read_stream_event(provider, event, stats)
+            if text:
+                parts.append(text)
+                yield text
+    finally:
+        await stream.close()
+    _finish_stream(model_type, stats, parts, cache, key)
+
+
+class StreamEvent(NamedTuple):
+    index: int  # position of the request in the batch
+    delta: str  # next piece of the response; a FailedResponse if the request failed
+    done: bool  # True on the last event of a request
+    stats: StreamStats
+
+
+async def aiter_stream_many(requests: List[Dict[str, Any]], max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                            max_concurrency_per_model: Optional[int] = None,
+                            capture_errors: bool = False) -> AsyncIterator[StreamEvent]:
+    """
+    Stream every request (a dict of `astream_generate` keyword arguments) at once, interleaving their
+    deltas as they arrive. `max_concurrency_per_model` additionally caps the streams open per model type.
+    """
+    events: "asyncio.Queue[Any]" = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    model_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def run(index, kwargs):
+        model_type = kwargs.get("model_type", "gpt-4")
+        if max_concurrency_per_model and model_type not in model_semaphores:
+            model_semaphores[model_type] = asyncio.Semaphore(max_concurrency_per_model)
+        model_semaphore = model_semaphores.get(model_type)
+        stats = StreamStats()
+        try:
+            if model_semaphore is not None:
+                await model_semaphore.acquire()
+            try:
+                async with semaphore:
+                    stats.started = time.monotonic()
+                    async for text in astream_generate(**kwargs, stats=stats):
+                        events.put_nowait(StreamEvent(index, text, False, stats))
+            finally:
+                if model_semaphore is not None:
+                    model_semaphore.release()
+            events.put_nowait(StreamEvent(index, "", True, stats))
+        except Exception as exc:
+            if not capture_errors:
+                events.put_nowait(exc)
+                return
+            stats.finished_at = time.monotonic()
+            events.put_nowait(StreamEvent(index, FailedResponse.from_exception(exc), True, stats))
+
+    tasks = [asyncio.ensure_future(run(index, kwargs)) for index, kwargs in enumerate(requests)]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await events.get()
+            if isinstance(event, Exception):
+                raise event
+            if event.done:
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def iter_stream_many(requests: Iterable[Dict[str, Any]], max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                     max_concurrency_per_model: Optional[int] = None,
+                     capture_errors: bool = False) -> Iterator[StreamEvent]:
+    """Blocking bridge to `aiter_stream_many`."""
+    return iterate_sync(aiter_stream_many(list(requests), max_concurrency, max_concurrency_per_model,
+                                          capture_errors))
+
+
+async def agenerate(messages: List[Dict[str, str]], model_type: supported_models = "gpt-4",
+                    use_cache: bool = True, timeout: float = REQUEST_TIMEOUT,
+                    deadline: Optional[Deadline] = None, hedge: Optional[HedgePolicy] = None,
+                    cacheable: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    Async counterpart of `generate`. With a `hedge` policy, a call that runs past the policy's latency
+    percentile for this model is raced against a duplicate request. With `cacheable`, only responses it
+    accepts are written to the cache (e.g. a fused evaluation that answered every criterion), so a
+    malformed one is sent again next time rather than replayed.
+    """
+    return (await _agenerate_choices(messages, model_type, 1, use_cache, timeout, deadline, hedge, cacheable))[0]
+
+
+async def agenerate_samples(messages: List[Dict[str, str]], model_type: supported_models = "gpt-4", n: int = 1,
+                            use_cache: bool = False, timeout: float = REQUEST_TIMEOUT,
+                            deadline: Optional[Deadline] = None, hedge: Optional[HedgePolicy] = None,
+                            cacheable: Optional[Callable[[str], bool]] = None) -> List[str]:
+    """
+    `n` independent responses from a single request using the provider's `n=` parameter, so the prompt
+    is sent (and billed) once. Only for models where `supports_multiple_samples` is true. `cacheable` is
+    as for `agenerate` and has to accept every sample.
+    """
+    if n > 1 and not supports_multiple_samples(model_type):
+        raise ValueError(f"{model_type} does not support multiple samples per request")
+    return await _agenerate_choices(messages, model_type, n, use_cache, timeout, deadline, hedge, cacheable)
+
+
+def supports_multiple_samples(model_type: str) -> bool:
+    # o1 models only accept n=1 and Anthropic has no equivalent
+    return model_type in ["gpt-4", "gpt-4o", "gpt-4-preview", "gpt-4-2024"]
+
+
+async def _agenerate_choices(messages: List[Dict[str, str]], model_type: str, n: int, use_cache: bool,
+                             timeout: float, deadline: Optional[Deadline],
+                             hedge: Optional[HedgePolicy],
+                             cacheable: Optional[Callable[[str], bool]] = None) -> List[str]:
+    provider, config, params = _build_request(messages, model_type, n)
+    cache, key = _lookup_cache(provider, config, params, use_cache)
+    if key is not None and (cached := cache.get(key)) is not None:
+        return [cached] if n == 1 else json.loads(cached)
+
+    answered_by = model_type
+    if hedge is None:
+        choices = await _agenerate_uncached(messages, model_type, n, timeout, deadline)
+    else:
+        fallback_model = hedge.fallback_model or model_type
+        if n > 1 and not supports_multiple_samples(fallback_model):
+            fallback_model = model_type
+        choices, primary_won = await run_hedged(
+            lambda: _agenerate_uncached(messages, model_type, n, timeout, deadline),
+            lambda: _agenerate_uncached(messages, fallback_model, n, timeout, deadline),
+            hedge.delay(model_type)
+        )
+        if not primary_won:
+            answered_by = fallback_model
+    # a hedge that won on another model must not be served later as this model's answer
+    if cacheable is not None and not all(cacheable(choice) for choice in choices):
+        return choices
+    if key is not None and answered_by == model_type:
+        cache.set(key, choices[0] if n == 1 else json.dumps(choices))
+    return choices
+
+
+async def _agenerate_uncached(messages: List[Dict[str, str]], model_type: str, n: int, timeout: float,
+                              deadline: Optional[Deadline]) -> List[str]:
+    provider, config, params = _build_request(messages, model_type, n)
+    started = time.monotonic()
+    raw = await acall_with_retry(lambda: _acreate(provider, config, params, timeout, deadline), deadline=deadline)
+    latency_tracker.observe(model_type, time.monotonic() - started)
+    return _parse_choices(provider, raw)
+
+
+class Completion(NamedTuple):
+    index: int  # position of the request in the batch
+    response: Any  # the response text (the list of choices for a multi-sample call)
+    elapsed: float  # seconds from dispatch to completion
+
+
+class SampleCompletion(NamedTuple):
+    index: int  # position of the request in the batch
+    sample: int  # which of the request's samples this is
+    response: str
+    elapsed: float
+
+
+async def _aiter_calls(calls: List[Dict[str, Any]], call: Callable[..., Awaitable[Any]], max_concurrency: int,
+                       deadline: Optional[float], capture_errors: bool, groups: Optional[List[Any]] = None,
+                       priorities: Optional[List[float]] = None) -> AsyncIterator[Completion]:
+    # slots go round-robin across groups, then by priority; every batch also shares the global limit
+    scheduler = FairScheduler(max_concurrency)
+    batch_id = object()
+    batch_deadline = Deadline(deadline) if deadline else None
+
+    async def run(index, kwargs):
+        group = groups[index] if groups is not None else None
+        priority = priorities[index] if priorities is not None else 0
+        async with batch_slot(scheduler, batch_id, group, priority):
+            started = time.monotonic()
+            try:
+                response = await call(**kwargs, deadline=batch_deadline)
+            except Exception as exc:
+                if not capture_errors:
+                    raise
+                response = FailedResponse.from_exception(exc)
+            return Completion(index, response, time.monotonic() - started)
+
+    tasks = [asyncio.ensure_future(run(index, kwargs)) for index, kwargs in enumerate(calls)]
+    try:
+        for next_completion in asyncio.as_completed(tasks):
+            yield await next_completion
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def aiter_generate_many(requests: List[Dict[str, Any]],
+                        max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                        deadline: Optional[float] = None,
+                        capture_errors: bool = False,
+                        groups: Optional[List[Any]] = None) -> AsyncIterator[Completion]:
+    """
+    Run every request (a dict of `agenerate` keyword arguments) on the current event loop with at most
+    `max_concurrency` in flight, yielding each `Completion` as soon as it finishes.
+
+    `deadline` is a budget in seconds for the whole batch. With `capture_errors` a request that still
+    fails after its retries yields a `FailedResponse` instead of aborting the batch. `groups` labels each
+    request (e.g. with its criterion); free slots are shared round-robin between groups.
+    """
+    return _aiter_calls(requests, agenerate, max_concurrency, deadline, capture_errors, groups)
 
 
-def generate(messages: List[Dict[str, str]], model_type: supported_models = "gpt-4"):
+async def aiter_generate_samples(requests: List[Dict[str, Any]], num_samples: int,
+                                 max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                                 deadline: Optional[float] = None,
+                                 capture_errors: bool = False,
+                                 groups: Optional[List[Any]] = None) -> AsyncIterator[SampleCompletion]:
+    """
+    Draw `num_samples` independent responses for every request, all queued at once. Models that accept
+    `n=` get one request returning every sample; the rest get one request per sample, and every request's
+    first sample is scheduled before anyone's second. Samples are not cached unless a request sets
+    `use_cache`, and never on the one-request-per-sample path. `groups` is as for `aiter_generate_many`.
+    """
+    units = []
+    calls = []
+    for index, request in enumerate(requests):
+        if num_samples > 1 and supports_multiple_samples(request.get("model_type", "gpt-4")):
+            units.append((index, 0))
+            calls.append({**request, "n": num_samples})
+        else:
+            for sample in range(num_samples):
+                units.append((index, sample))
+                calls.append({**request, "n": 1, "use_cache": num_samples == 1 and request.get("use_cache", False)})
+    call_groups = [groups[index] for index, _ in units] if groups is not None else None
+    priorities = [sample for _, sample in units]
+
+    async for completion in _aiter_calls(calls, agenerate_samples, max_concurrency, deadline, capture_errors,
+                                         call_groups, priorities):
+        index, first_sample = units[completion.index]
+        choices = completion.response
+        if isinstance(choices, FailedResponse):
+            choices = [choices] * calls[completion.index]["n"]
+        for offset, response in enumerate(choices):
+            yield SampleCompletion(index, first_sample + offset, response, completion.elapsed)
+
+
+async def agenerate_many(requests: Iterable[Dict[str, Any]],
+                         max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                         deadline: Optional[float] = None,
+                         capture_errors: bool = False) -> List[str]:
+    """Like `aiter_generate_many`, but waits for the whole batch and returns responses in request order."""
+    requests = list(requests)
+    responses: List[Optional[str]] = [None] * len(requests)
+    async for completion in aiter_generate_many(requests, max_concurrency, deadline, capture_errors):
+        responses[completion.index] = completion.response
+    return responses
+
+
+def generate_many(requests: Iterable[Dict[str, Any]], max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                  deadline: Optional[float] = None, capture_errors: bool = False) -> List[str]:
+    """Blocking bridge to `agenerate_many` for Streamlit pages and other sync callers."""
+    return run_sync(agenerate_many(list(requests), max_concurrency, deadline, capture_errors))
+
+
+def iter_generate_many(requests: Iterable[Dict[str, Any]], max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                       deadline: Optional[float] = None, capture_errors: bool = False,
+                       groups: Optional[List[Any]] = None) -> Iterator[Completion]:
+    """Blocking bridge to `aiter_generate_many`: yields completions in the calling thread as they finish."""
+    return iterate_sync(aiter_generate_many(list(requests), max_concurrency, deadline, capture_errors, groups))
+
+
+def iter_generate_samples(requests: Iterable[Dict[str, Any]], num_samples: int,
+                          max_concurrency: int = MAX_ASYNC_CONCURRENCY, deadline: Optional[float] = None,
+                          capture_errors: bool = False,
+                          groups: Optional[List[Any]] = None) -> Iterator[SampleCompletion]:
+    """Blocking bridge to `aiter_generate_samples`."""
+    return iterate_sync(aiter_generate_samples(list(requests), num_samples, max_concurrency, deadline,
+                                               capture_errors, groups))
+
+
+def _build_request(messages: List[Dict[str, str]], model_type: str,
+                   n: int = 1) -> Tuple[str, Dict[str, Any], Dict[str, Any]]:
+    """Resolve `model_type` to (provider, client config, create() params)."""
     if model_type in ["gpt-4-preview", "gpt-4-2024"]:
-        return _generate_azure_openai(messages, model_type)
+        provider, config, params = _azure_openai_request(messages, model_type)
     elif model_type in ["gpt-4", "gpt-4-o1-preview", "gpt-4o"]:
-        return _generate_openai(messages, model_type)
+        provider, config, params = _openai_request(messages, model_type)
     elif model_type == "anthropic":
-        return _generate_anthropic(messages)
+        provider, config, params = _anthropic_request(messages)
     elif model_type == "llama3":
-        return _generate_llama3(messages)
+        raise NotImplementedError("Llama3 generation is not currently supported.")
     else:
         raise ValueError(f"Invalid model type: {model_type}")
 
+    if n > 1:
+        params["n"] = n
+    return provider, config, params
+
+
+def _lookup_cache(provider: str, config: Dict[str, Any], params: Dict[str, Any], use_cache: bool):
+    cache = get_cache() if use_cache else None
+    if cache is None:
+        return None, None
+    # key on where the request goes, but not on the credentials used to send it
+    endpoint = {name: config[name] for name in ("base_url", "api_version", "aws_region") if name in config}
+    return cache, cache_key(provider, params, endpoint)
+
+
+def _create(provider: str, config: Dict[str, Any], params: Dict[str, Any], timeout: float,
+            deadline: Optional[Deadline]):
+    client = get_client(provider, **config)
+    limiter = get_rate_limiter(provider, params["model"])
+    estimate = estimate_tokens(params)
+    if limiter is not None:
+        time.sleep(limiter.reserve(estimate))
+
+    if deadline is not None:
+        timeout = deadline.timeout(timeout)
+    response = _endpoint(client, provider).create(**params, timeout=timeout)
+    if limiter is not None:
+        limiter.settle(estimate, _usage_tokens(provider, response))
+    _record_prompt_usage(provider, response)
+    return response
+
+
+async def _acreate(provider: str, config: Dict[str, Any], params: Dict[str, Any], timeout: float,
+                   deadline: Optional[Deadline]):
+    client = get_async_client(provider, **config)
+    limiter = get_rate_limiter(provider, params["model"])
+    estimate = estimate_tokens(params)
+    if limiter is not None:
+        await asyncio.sleep(limiter.reserve(estimate))
+
+    controller = get_concurrency_controller(provider, params["model"])
+    await controller.acquire()
+    started = time.monotonic()
+    try:
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        # the SDK timeout is per socket operation; wait_for also catches a response that trickles in forever
+        response = await asyncio.wait_for(_endpoint(client, provider).create(**params, timeout=timeout), timeout)
+    except BaseException as exc:
+        controller.release(throttled=is_throttled(exc))
+        raise
+    controller.release(latency=time.monotonic() - started)
+
+    if limiter is not None:
+        limiter.settle(estimate, _usage_tokens(provider, response))
+    _record_prompt_usage(provider, response)
+    return response
+
+
+def _endpoint(client, provider: str):
+    return client.messages if provider == "anthropic_bedrock" else client.chat.completions
+
+
+def _parse_choices(provider: str, response) -> List[str]:
+    if provider == "anthropic_bedrock":
+        return [response.content[0].text]
+    return [choice.message.content for choice in sorted(response.choices, key=lambda choice: choice.index)]
+
 
-def _generate_azure_openai(messages: List[Dict[str, str]], model_type: str) -> str:
-    from openai import AzureOpenAI
+def _stream_params(provider: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    stream_params = {**params, "stream": True}
+    if provider == "openai":
+        # ask for a final usage chunk; the pinned SDK predates the stream_options argument
+        stream_params["extra_body"] = {"stream_options": {"include_usage": True}}
+    return stream_params
 
+
+def _read_stream_event(provider: str, event, stats: StreamStats) -> Optional[str]:
+    """The text delta in one streamed event, updating `stats` with timing and reported usage."""
+    text = None
+    if provider == "anthropic_bedrock":
+        if event.type == "content_block_delta":
+            text = getattr(event.delta, "text", None)
+        elif event.type == "message_delta":
+            stats.output_tokens = event.usage.output_tokens
+    else:
+        usage = getattr(event, "usage", None)
+        if usage is not None:
+            stats.output_tokens = _field(usage, "completion_tokens") or stats.output_tokens
+        if event.choices:
+            text = event.choices[0].delta.content
+    if text and stats.first_token_at is None:
+        stats.first_token_at = time.monotonic()
+    return text
+
+
+def _finish_stream(model_type: str, stats: StreamStats, parts: List[str], cache, key: Optional[str]):
+    stats.finished_at = time.monotonic()
+    if not stats.output_tokens:
+        stats.output_tokens = math.ceil(sum(len(part) for part in parts) / CHARS_PER_TOKEN)
+    latency_tracker.observe(model_type, stats.finished_at - stats.started)
+    if key is not None:
+        cache.set(key, "".join(parts))
+
+
+def _usage_tokens(provider: str, response) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    if provider == "anthropic_bedrock":
+        return usage.input_tokens + usage.output_tokens
+    return usage.total_tokens
+
+
+def _field(obj, name: str):
+    # usage fields newer than the pinned SDKs arrive as plain dicts or extra attributes
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _record_prompt_usage(provider: str, response):
+    """Count prompt tokens and how many of them were served from the provider's prompt cache."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    if provider == "anthropic_bedrock":
+        cache_read = _field(usage, "cache_read_input_tokens") or 0
+        cache_write = _field(usage, "cache_creation_input_tokens") or 0
+        # Anthropic's input_tokens excludes the cached part
+        prompt_tokens = usage.input_tokens + cache_read + cache_write
+        metrics.increment("prompt_cache.write_tokens", cache_write)
+    else:
+        cache_read = _field(_field(usage, "prompt_tokens_details"), "cached_tokens") or 0
+        prompt_tokens = usage.prompt_tokens
+    metrics.increment("tokens.prompt", prompt_tokens)
+    metrics.increment("prompt_cache.read_tokens", cache_read)
+
+
+def _text(content) -> str:
+    if isinstance(content, str):
+        return content
+    return "\n".join(block["text"] for block in content)
+
+
+def _flatten(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    return [{**message, "content": _text(message["content"])} for message in messages]
+
+
+def _cacheable(prefix_chars: int) -> bool:
+    return PROMPT_CACHING and prefix_chars / CHARS_PER_TOKEN >= MIN_CACHEABLE_TOKENS
+
+
+def _azure_openai_request(messages: List[Dict[str, str]], model_type: str):
     api_versions = {
         "gpt-4": "2023-05-15",
         "gpt-4-preview": "2023-07-01-preview",
         "gpt-4-2024": "2024-02-01"
     }
 
-    client = AzureOpenAI(
+    config = dict(
         api_key=os.getenv("AZURE_OPENAI_API_KEY"),
         base_url=os.getenv("AZURE_OPENAI_BASE_URL"),
         api_version=api_versions[model_type],
     )
-
-    response = client.chat.completions.create(
+    params = dict(
         model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "GPT4_32K"),
-        messages=messages,
+        messages=_flatten(messages),
         frequency_penalty=1.1
     )
-    return response.choices[0].message.content
-
-
-def _generate_openai(messages: List[Dict[str, str]], model_type: str) -> str:
-    from openai import OpenAI
+    return "azure_openai", config, params
 
-    client = OpenAI(api_key=get_openai_api_key())
 
+def _openai_request(messages: List[Dict[str, str]], model_type: str):
     model = "o1-preview" if model_type == "gpt-4-o1-preview" else "gpt-4o-2024-05-13"
 
-    response = client.chat.completions.create(
+    params = dict(
         model=model,
-        messages=messages if model_type == "gpt-4o" else [
-            {"role": "user", "content": " ".join([m["content"] for m in messages])}]
+        messages=_flatten(messages) if model_type == "gpt-4o" else [
+            {"role": "user", "content": " ".join([_text(m["content"]) for m in messages])}]
     )
-    return response.choices[0].message.content
+    return "openai", dict(api_key=get_openai_api_key()), params
 
 
-def _generate_anthropic(messages: List[Dict[str, str]]) -> str:
-    from anthropic import AnthropicBedrock
-    print("Generating wiht anthropic")
-    print(os.getenv("AWS_ACCESS_KEY"))
-
-    client = AnthropicBedrock(
+def _anthropic_request(messages: List[Dict[str, str]]):
+    config = dict(
         aws_access_key=os.getenv("AWS_ACCESS_KEY"),
         aws_secret_key=os.getenv("AWS_SECRET_KEY"),
         aws_region=os.getenv("AWS_REGION", "us-east-1"),
     )
-
-    response = client.messages.create(
+    system = _text(messages[0]["content"])
+    params = dict(
         model=os.getenv("ANTHROPIC_MODEL", "anthropic.claude-3-5-sonnet-20240620-v1:0"),
         max_tokens=256,
-        system=messages[0]["content"],
+        system=system,
         messages=messages[1:]
     )
-    return response.content[0].text
-
 
-def _generate_llama3(messages: List[Dict[str, str]]) -> str:
-    raise NotImplementedError("Llama3 generation is not currently supported.")
+    # cache breakpoints after the system prompt and after the shared first block of each user message;
+    # Anthropic allows at most MAX_CACHE_BREAKPOINTS
+    prefix_chars = len(system)
+    breakpoints = 0
+    if _cacheable(prefix_chars):
+        breakpoints += 1
+        params["system"] = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+    messages = []
+    for message in params["messages"]:
+        content = message["content"]
+        if (isinstance(content, list) and len(content) > 1 and breakpoints < MAX_CACHE_BREAKPOINTS
+                and _cacheable(prefix_chars + len(content[0]["text"]))):
+            breakpoints += 1
+            content = [{**content[0], "cache_control": {"type": "ephemeral"}}] + content[1:]
+        prefix_chars += len(_text(content))
+        messages.append({**message, "content": content})
+    params["messages"] = messages
+    if breakpoints:
+        params["extra_headers"] = {"anthropic-beta": PROMPT_CACHING_BETA}
+    return "anthropic_bedrock", config, params
@@ -0,0 +1,28 @@
+import threading
+from collections import Counter
+from typing import Dict
+
+# Process-wide counters shared by the generation layer (cache hits, retries, ...).
+_counters: Counter = Counter()
+_lock = threading.Lock()
+
+
+def increment(name: str, value: float = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot() -> Dict[str, float]:
+    with _lock:
+        return dict(_counters)
+
+
+def since(before: Dict[str, float]) -> Dict[str, float]:
+    """Counters that moved since `before` (an earlier `snapshot()`), e.g. the stats for one run."""
+    now = snapshot()
+    return {name: value - before.get(name, 0) for name, value in now.items() if value != before.get(name, 0)}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
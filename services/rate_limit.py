@@ -0,0 +1,203 @@
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from . import metrics
+from .clients import MAX_ASYNC_CONCURRENCY
+
+# Requests and tokens per minute per provider (or "provider/model" for a single deployment).
+# Override with PROMPTLAB_RATE_LIMITS, e.g. '{"azure_openai/GPT4_32K": {"rpm": 60, "tpm": 40000}}'.
+DEFAULT_RATE_LIMITS = {
+    "openai": {"rpm": 5000, "tpm": 800_000},
+    "azure_openai": {"rpm": 300, "tpm": 50_000},
+    "anthropic_bedrock": {"rpm": 50, "tpm": 400_000},
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.getenv("PROMPTLAB_RATE_LIMITS", "{}"))}
+# Fraction of every limit this process may use; sharded runs split the quota between their workers.
+RATE_LIMIT_SHARE = float(os.getenv("PROMPTLAB_RATE_LIMIT_SHARE", "1"))
+
+# assumed completion length when the request does not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 512
+CHARS_PER_TOKEN = 4
+
+
+def _text_length(content) -> int:
+    if isinstance(content, str):
+        return len(content)
+    if isinstance(content, list):
+        return sum(len(block.get("text", "")) for block in content if isinstance(block, dict))
+    return 0
+
+
+def estimate_tokens(params: Dict[str, Any]) -> int:
+    """Rough prompt + completion token count for a create() call, used before the real usage is known."""
+    chars = _text_length(params.get("system", ""))
+    chars += sum(_text_length(message.get("content", "")) for message in params.get("messages", []))
+    completion = params.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return math.ceil(chars / CHARS_PER_TOKEN) + completion * params.get("n", 1)
+
+
+def is_throttled(exc: BaseException) -> bool:
+    return getattr(exc, "status_code", None) == 429
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute`; callers reserve capacity up front and sleep off any debt."""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` now and return how many seconds the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount: float):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Request and token budgets for one provider deployment."""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def reserve(self, estimated_tokens: int) -> float:
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if wait:
+            metrics.increment("rate_limit.wait_seconds", wait)
+        return wait
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Correct the token bucket once the response reports what the call really used."""
+        if actual_tokens is not None:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on in-flight requests. Like TCP, the limit doubles per round of successful calls until
+    the first sign of trouble, then grows by roughly one per round. It is cut multiplicatively on a
+    429 or when recent latency inflates well past its long-run average, so a batch settles just under
+    what the provider will actually serve.
+    """
+
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = MAX_ASYNC_CONCURRENCY,
+                 backoff: float = 0.5, latency_tolerance: float = 3.0, cooldown: float = 2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._recent_latency: Optional[float] = None
+        self._baseline_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self._waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # we may have been handed a free slot just before being cancelled - pass it on
+                self._wake(1)
+                raise
+
+    def release(self, latency: Optional[float] = None, throttled: bool = False):
+        with self._lock:
+            self.in_flight -= 1
+            if throttled:
+                self._decrease()
+                metrics.increment("rate_limit.throttled")
+            elif latency is not None:
+                self._observe(latency)
+            free = int(self.limit) - self.in_flight
+        self._wake(free)
+
+    def _observe(self, latency: float):
+        if self._recent_latency is None:
+            self._recent_latency = self._baseline_latency = latency
+        self._recent_latency = 0.7 * self._recent_latency + 0.3 * latency
+        self._baseline_latency = 0.98 * self._baseline_latency + 0.02 * latency
+        if self._recent_latency > self.latency_tolerance * self._baseline_latency:
+            self._decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + (1 if self._slow_start else 1 / self.limit))
+
+    def _decrease(self):
+        now = time.monotonic()
+        # one burst of throttling is one signal, not one per failed request
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            self._last_decrease = now
+            self._slow_start = False
+
+    def _wake(self, count: int):
+        woken = 0
+        while woken < count:
+            with self._lock:
+                if not self._waiters:
+                    return
+                loop, waiter = self._waiters.popleft()
+            if not waiter.done():
+                loop.call_soon_threadsafe(_resolve, waiter)
+                woken += 1
+
+
+def _resolve(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_controllers: Dict[str, AdaptiveConcurrency] = {}
+_lock = threading.Lock()
+
+
+def _limits_for(provider: str, model: str) -> Dict[str, float]:
+    return RATE_LIMITS.get(f"{provider}/{model}") or RATE_LIMITS.get(provider) or {}
+
+
+def get_rate_limiter(provider: str, model: str) -> Optional[RateLimiter]:
+    """Shared limiter for a provider deployment, or None when no limits are configured for it."""
+    key = f"{provider}/{model}"
+    with _lock:
+        if key not in _limiters:
+            limits = _limits_for(provider, model)
+            _limiters[key] = RateLimiter(limits["rpm"] * RATE_LIMIT_SHARE,
+                                         limits["tpm"] * RATE_LIMIT_SHARE) if limits else None
+        return _limiters[key]
+
+
+def get_concurrency_controller(provider: str, model: str) -> AdaptiveConcurrency:
+    key = f"{provider}/{model}"
+    with _lock:
+        if key not in _controllers:
+            _controllers[key] = AdaptiveConcurrency()
+        return _controllers[key]
@@ -0,0 +1,115 @@
+import asyncio
+import email.utils
+import os
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+REQUEST_TIMEOUT = float(os.getenv("PROMPTLAB_REQUEST_TIMEOUT", "180"))
+MAX_ATTEMPTS = int(os.getenv("PROMPTLAB_MAX_ATTEMPTS", "5"))
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+# connection and timeout errors from both SDKs share these names
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError"}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """A wall-clock budget shared by every call in a batch."""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, timeout: float) -> float:
+        """The per-call timeout, cut down to what is left of the budget."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Batch deadline exceeded")
+        return min(timeout, remaining)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(exc, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(exc).__mro__)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait, from `retry-after-ms` or `retry-after` (seconds or HTTP date)."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, exc: BaseException) -> float:
+    """Full-jitter exponential backoff, unless the server told us how long to wait."""
+    requested = retry_after(exc)
+    if requested is not None:
+        return min(MAX_DELAY, requested) + random.uniform(0, BASE_DELAY)
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def _next_delay(attempt: int, exc: BaseException, max_attempts: int, deadline: Optional[Deadline]) -> Optional[float]:
+    if attempt >= max_attempts or not is_retryable(exc):
+        return None
+    delay = backoff_delay(attempt, exc)
+    if deadline is not None and deadline.remaining() <= delay:
+        return None
+    metrics.increment("retry.retries")
+    return delay
+
+
+def call_with_retry(fn: Callable[[], T], max_attempts: int = MAX_ATTEMPTS, deadline: Optional[Deadline] = None) -> T:
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as exc:
+            attempt += 1
+            delay = _next_delay(attempt, exc, max_attempts, deadline)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+
+async def acall_with_retry(fn: Callable[[], Awaitable[T]], max_attempts: int = MAX_ATTEMPTS,
+                           deadline: Optional[Deadline] = None) -> T:
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as exc:
+            attempt += 1
+            delay = _next_delay(attempt, exc, max_attempts, deadline)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
@@ -0,0 +1,374 @@
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import IO, Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import pandas as pd
+
+from helpers.io import read_table, table_format, write_table
+from prompts.evaluation_prompts import (get_criteria, is_complete_response, render_evaluation_inputs, score_response,
+                                        split_response)
+from prompts.templates import PromptTemplate
+
+from .clients import MAX_ASYNC_CONCURRENCY
+from .journal import RunJournal, make_row_key, make_run_id
+from .llm_service import FailedResponse, iter_generate_many
+from .rate_limit import RATE_LIMIT_SHARE
+
+
+class Progress(NamedTuple):
+    completed: int
+    total: int
+    failed: int
+    resumed: int
+    elapsed: float
+
+
+class RowResult(NamedTuple):
+    position: int  # row position in the input table
+    column: str
+    response: str
+    score: Optional[int] = None
+
+
+def load_table(path: str, start: Optional[int] = None, stop: Optional[int] = None) -> pd.DataFrame:
+    """The table at `path`, or just rows [start, stop) of it, indexed by their position in the whole file."""
+    if start is None:
+        return read_table(path)
+    if table_format(path) == "csv":
+        df = pd.read_csv(path, skiprows=range(1, start + 1), nrows=stop - start)
+    else:
+        df = read_table(path).iloc[start:stop]
+    df.index = range(start, start + len(df))
+    return df
+
+
+def count_rows(path: str) -> int:
+    if table_format(path) == "parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    if table_format(path) == "arrow":
+        import pyarrow as pa
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all().num_rows
+    return len(pd.read_csv(path, usecols=[0]))
+
+
+def table_columns(path: str) -> List[str]:
+    """The column names of the table at `path`, read from its header or schema only."""
+    if table_format(path) == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+    if table_format(path) == "arrow":
+        import pyarrow as pa
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).schema.names
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+
+def run_generation(df: pd.DataFrame, system_prompt: str, user_prompt: str, model_type: str, output_column: str,
+                   use_cache: bool = True, resume: bool = True, max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                   deadline: Optional[float] = None,
+                   on_progress: Optional[Callable[[Progress], None]] = None,
+                   finish_journal: bool = True) -> Iterator[RowResult]:
+    """
+    Generate `output_column` for every row, yielding results as rows finish. Checkpoints are shared with
+    the app's Generate button, so a run started in either can be resumed from the other; they are dropped
+    once a run ends without failures unless `finish_journal` is false. Raises UnknownColumnError up front
+    if the user prompt refers to a column the table doesn't have.
+    """
+    requests = [
+        {
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": content}
+            ],
+            "model_type": model_type,
+            "use_cache": use_cache
+        }
+        for content in PromptTemplate(user_prompt).render_all(df)
+    ]
+
+    journal = generation_journal(system_prompt, user_prompt, model_type, output_column)
+    row_keys = [make_row_key(index, request["messages"]) for index, request in zip(df.index, requests)]
+    units = [(position, output_column, row_keys[position], requests[position]) for position in range(len(df))]
+    yield from _run_units(journal, units, resume, max_concurrency, deadline, on_progress, len(df), finish_journal)
+
+
+def run_evaluation(df: pd.DataFrame, notes_column: str, transcript_column: str, model_type: str,
+                   fused: bool = False, resume: bool = True, max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                   deadline: Optional[float] = None,
+                   on_progress: Optional[Callable[[Progress], None]] = None,
+                   finish_journal: bool = True) -> Iterator[RowResult]:
+    """Score every row against the `prompts/evaluation_prompts` criteria, as the Evaluation page does."""
+    criteria_list = get_criteria(fused=fused)
+    journal = evaluation_journal(criteria_list, model_type, notes_column, transcript_column)
+    user_prompts = render_evaluation_inputs(df, notes_column, transcript_column, criteria_list)
+    row_keys = [make_row_key(index, notes, transcript) for index, notes, transcript
+                in zip(df.index, df[notes_column].tolist(), df[transcript_column].tolist())]
+
+    units = []
+    for criterion in criteria_list:
+        for position, content in enumerate(user_prompts[criterion['input_required']]):
+            messages = [
+                {"role": "system", "content": criterion['prompt']},
+                {"role": "user", "content": content}
+            ]
+            request = {"messages": messages, "model_type": model_type,
+                       "cacheable": partial(is_complete_response, criterion)}
+            units.append((position, criterion, row_keys[position], request))
+
+    total = len(df) * sum(len(_columns(criterion)) for criterion in criteria_list)
+    yield from _run_units(journal, units, resume, max_concurrency, deadline, on_progress, total, finish_journal)
+
+
+def generation_journal(system_prompt: str, user_prompt: str, model_type: str, output_column: str) -> RunJournal:
+    return RunJournal(make_run_id("generate", system_prompt, user_prompt, model_type, output_column))
+
+
+def evaluation_journal(criteria_list: List[Dict[str, Any]], model_type: str, notes_column: str,
+                       transcript_column: str) -> RunJournal:
+    return RunJournal(make_run_id("evaluate", [criterion['prompt'] for criterion in criteria_list],
+                                  model_type, notes_column, transcript_column))
+
+
+def _columns(target) -> List[str]:
+    if isinstance(target, str):
+        return [target]
+    return [member['title'] for member in target.get('criteria', [target])]
+
+
+def _journal_label(target, column: str) -> str:
+    # generation runs are checkpointed without a criterion, as in the app
+    return "" if isinstance(target, str) else column
+
+
+def _split(target, response) -> Dict[str, Any]:
+    """Per-column responses for a unit; `target` is an output column name or a (possibly fused) criterion."""
+    if isinstance(target, str):
+        return {target: response}
+    return split_response(target, response)
+
+
+def _result(position: int, target, column: str, response: str) -> RowResult:
+    if isinstance(target, str):
+        return RowResult(position, column, response)
+    members = target.get('criteria', [target])
+    response_type = next(member['type'] for member in members if member['title'] == column)
+    return RowResult(position, column, response, score_response(response, response_type))
+
+
+def _run_units(journal: RunJournal, units, resume: bool, max_concurrency: int, deadline: Optional[float],
+               on_progress: Optional[Callable[[Progress], None]], total: int,
+               finish_journal: bool = True) -> Iterator[RowResult]:
+    # unit: (row position, output column or criterion, row key, request)
+    if not resume:
+        journal.reset()
+    checkpointed = journal.completed()
+
+    started = time.monotonic()
+    completed = failed = 0
+    pending = []
+    for unit in units:
+        position, target, row_key, _ = unit
+        checkpoints = [(row_key, _journal_label(target, column), 0) for column in _columns(target)]
+        if all(checkpoint in checkpointed for checkpoint in checkpoints):
+            for column, checkpoint in zip(_columns(target), checkpoints):
+                completed += 1
+                yield _result(position, target, column, checkpointed[checkpoint])
+        else:
+            pending.append(unit)
+    resumed = completed
+    # reported before dispatching, so resumed rows (and a shard with nothing left to do) are counted
+    if on_progress is not None:
+        on_progress(Progress(completed, total, failed, resumed, time.monotonic() - started))
+
+    try:
+        # share slots fairly between criteria (a generation run is a single group)
+        groups = [target if isinstance(target, str) else target['title'] for _, target, _, _ in pending]
+        for completion in iter_generate_many([unit[3] for unit in pending], max_concurrency, deadline,
+                                             capture_errors=True, groups=groups):
+            position, target, row_key, _ = pending[completion.index]
+            for column, response in _split(target, completion.response).items():
+                completed += 1
+                if isinstance(response, FailedResponse):
+                    failed += 1
+                else:
+                    journal.record(row_key, response, criterion=_journal_label(target, column))
+                yield _result(position, target, column, response)
+            if on_progress is not None:
+                on_progress(Progress(completed, total, failed, resumed, time.monotonic() - started))
+        if finish_journal and not failed:
+            journal.finish()
+    finally:
+        journal.close()
+
+
+class ResultWriter:
+    """
+    Writes results as they arrive: `.jsonl` and `.csv` outputs get one record per result, flushed as it is
+    written, so a long run's output can be tailed; `.parquet` and `.arrow` can't be appended to and are written
+    on close.
+    """
+
+    def __init__(self, path: str, df: Optional[pd.DataFrame] = None, row_offset: int = 0):
+        self.path = path
+        self.df = df
+        self.row_offset = row_offset
+        self._format = os.path.splitext(path)[1].lstrip(".").lower() or "jsonl"
+        self._records: List[Dict[str, Any]] = []
+        self._file: Optional[IO[str]] = None
+        self._csv = None
+        if self._format not in ("parquet", "arrow"):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "w", encoding="utf-8", newline="")
+
+    def write(self, result: RowResult):
+        self.write_record({
+            "row": self.row_offset + int(result.position), "index": _plain(self.df.index[result.position]),
+            "column": result.column, "response": str(result.response),
+            "failed": isinstance(result.response, FailedResponse), "score": result.score
+        })
+
+    def write_record(self, record: Dict[str, Any]):
+        if self._format in ("parquet", "arrow"):
+            self._records.append(record)
+        elif self._format == "csv":
+            if self._csv is None:
+                self._csv = csv.DictWriter(self._file, fieldnames=list(record))
+                self._csv.writeheader()
+            self._csv.writerow(record)
+            self._file.flush()
+        else:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        else:
+            write_table(pd.DataFrame(self._records), self.path, self._format)
+
+
+def _plain(value):
+    # numpy scalars in a dataframe index aren't JSON serializable
+    return value.item() if hasattr(value, "item") else value
+
+
+def run_sharded(task: str, input_path: str, output_path: str, num_shards: int,
+                max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                on_progress: Optional[Callable[[Progress], None]] = None, **task_options) -> int:
+    """
+    Split the input into `num_shards` contiguous row ranges and run `task` ("generate" or "evaluate", with
+    the keyword arguments of `run_generation` / `run_evaluation`) on each in its own process. Concurrency
+    and provider rate limits are divided between the workers. Shard outputs are merged into `output_path`
+    in row order (columns in criteria order), whatever order rows finished in. Returns the failed count.
+    """
+    total_rows = count_rows(input_path)
+    bounds = [total_rows * shard // num_shards for shard in range(num_shards + 1)]
+    shard_dir = output_path + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_paths = [os.path.join(shard_dir, f"shard-{shard:04d}.jsonl") for shard in range(num_shards)]
+    # the shards share one checkpoint, so it is reset and finished here rather than by each of them
+    journal = _task_journal(task, task_options)
+    if not task_options.get("resume", True):
+        journal.reset()
+    shard_options = {**task_options, "resume": True, "finish_journal": False}
+
+    # read by the workers' services at import time
+    worker_env = {
+        "PROMPTLAB_MAX_ASYNC_CONCURRENCY": str(max(1, max_concurrency // num_shards)),
+        "PROMPTLAB_RATE_LIMIT_SHARE": str(RATE_LIMIT_SHARE / num_shards),
+    }
+    saved_env = {name: os.environ.get(name) for name in worker_env}
+    os.environ.update(worker_env)
+    try:
+        with multiprocessing.get_context("spawn").Manager() as manager:
+            progress_queue = manager.Queue()
+            # spawn, not fork: the parent may have a live event-loop thread and open connections
+            with ProcessPoolExecutor(num_shards, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [
+                    pool.submit(_run_shard, task, input_path, bounds[shard], bounds[shard + 1], shard_paths[shard],
+                                shard, progress_queue, shard_options)
+                    for shard in range(num_shards)
+                ]
+                _watch_shards(futures, progress_queue, num_shards, on_progress)
+                for future in futures:
+                    future.result()
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    column_order = _column_order(task, task_options)
+    writer = ResultWriter(output_path)
+    failed = 0
+    try:
+        # shards hold contiguous row ranges, so sorting each one and concatenating them in order is a full sort
+        for shard_path in shard_paths:
+            with open(shard_path, encoding="utf-8") as shard_file:
+                records = [json.loads(line) for line in shard_file if line.strip()]
+            records.sort(key=lambda record: (record["row"], column_order.get(record["column"], len(column_order))))
+            for record in records:
+                failed += record["failed"]
+                writer.write_record(record)
+    finally:
+        writer.close()
+    shutil.rmtree(shard_dir)
+    if not failed:
+        journal.finish()
+    return failed
+
+
+def _run_shard(task: str, input_path: str, start: int, stop: int, shard_path: str, shard: int, progress_queue,
+               task_options: Dict[str, Any]):
+    df = load_table(input_path, start, stop)
+    run = run_generation if task == "generate" else run_evaluation
+    writer = ResultWriter(shard_path, df, row_offset=start)
+    try:
+        for result in run(df, **task_options, on_progress=lambda progress: progress_queue.put((shard, progress))):
+            writer.write(result)
+    finally:
+        writer.close()
+    progress_queue.put((shard, None))
+
+
+def _watch_shards(futures, progress_queue, num_shards: int, on_progress: Optional[Callable[[Progress], None]]):
+    latest: Dict[int, Progress] = {}
+    finished = set()
+    while len(finished) < num_shards and not any(future.done() and future.exception() for future in futures):
+        try:
+            shard, progress = progress_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if progress is None:
+            finished.add(shard)
+            continue
+        latest[shard] = progress
+        if on_progress is not None:
+            shards = latest.values()
+            on_progress(Progress(sum(p.completed for p in shards), sum(p.total for p in shards),
+                                 sum(p.failed for p in shards), sum(p.resumed for p in shards),
+                                 max(p.elapsed for p in shards)))
+
+
+def _task_journal(task: str, task_options: Dict[str, Any]) -> RunJournal:
+    if task == "generate":
+        return generation_journal(task_options["system_prompt"], task_options["user_prompt"],
+                                  task_options["model_type"], task_options["output_column"])
+    return evaluation_journal(get_criteria(fused=task_options.get("fused", False)), task_options["model_type"],
+                              task_options["notes_column"], task_options["transcript_column"])
+
+
+def _column_order(task: str, task_options: Dict[str, Any]) -> Dict[str, int]:
+    if task == "generate":
+        return {task_options["output_column"]: 0}
+    return {criterion['title']: rank for rank, criterion in enumerate(get_criteria())}
@@ -0,0 +1,148 @@
+import asyncio
+import math
+import os
+import statistics
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from .clients import MAX_ASYNC_CONCURRENCY
+from .event_loop import iterate_sync
+from .llm_service import FailedResponse, agenerate_samples, supports_multiple_samples
+from .retry import Deadline
+from .scheduler import FairScheduler, batch_slot
+
+# Full width of the 95% confidence interval on the mean score at which a unit stops sampling.
+DEFAULT_CI_WIDTH = float(os.getenv("PROMPTLAB_CI_WIDTH", "1.0"))
+MIN_SAMPLES = 3
+
+# two-sided 95% Student t critical values by degrees of freedom; past 30 the normal value is close enough
+_T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+         2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+         2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def t_critical(df: float) -> float:
+    """Two-sided 95% critical value for `df` degrees of freedom (rounded down, so slightly conservative)."""
+    df = max(1, int(df))
+    return _T_95[df - 1] if df <= len(_T_95) else 1.96
+
+
+def ci_width(scores: List[float]) -> float:
+    """Full width of the 95% confidence interval on the mean of `scores` (inf below two scores)."""
+    if len(scores) < 2:
+        return math.inf
+    return 2 * t_critical(len(scores) - 1) * statistics.stdev(scores) / math.sqrt(len(scores))
+
+
+def samples_needed(scores: List[float], target_width: float) -> float:
+    """
+    Rough number of scores (two or more so far) at which the interval on their mean would be `target_width`
+    wide, assuming the spread seen so far holds; at least one more than there are. inf for a zero target.
+    """
+    if target_width <= 0:
+        return math.inf
+    spread = 2 * t_critical(len(scores) - 1) * statistics.stdev(scores) / target_width
+    return max(len(scores) + 1, math.ceil(spread ** 2))
+
+
+def mean_difference(scores: List[float], baseline: List[float]) -> Tuple[float, float]:
+    """
+    Difference of means (`scores` - `baseline`) and the half-width of its 95% confidence interval, using
+    Welch's interval since the two sides have independent samples of possibly different sizes and spread.
+    The half-width is inf while either side has fewer than two scores.
+    """
+    difference = statistics.fmean(scores) - statistics.fmean(baseline)
+    if len(scores) < 2 or len(baseline) < 2:
+        return difference, math.inf
+    var_a = statistics.variance(scores) / len(scores)
+    var_b = statistics.variance(baseline) / len(baseline)
+    standard_error = math.sqrt(var_a + var_b)
+    if standard_error == 0:
+        return difference, 0.0
+    df = (var_a + var_b) ** 2 / (var_a ** 2 / (len(scores) - 1) + var_b ** 2 / (len(baseline) - 1))
+    return difference, t_critical(df) * standard_error
+
+
+class AdaptiveResult(NamedTuple):
+    index: int  # position of the request in the batch
+    responses: List[str]
+    scores: List[Optional[float]]
+    converged: bool  # False if the sample budget ran out first
+
+
+async def aiter_sample_until_converged(requests: List[Dict[str, Any]],
+                                       score: Callable[[int, str], Optional[float]],
+                                       max_samples: int,
+                                       target_width: float = DEFAULT_CI_WIDTH,
+                                       min_samples: int = MIN_SAMPLES,
+                                       max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                                       deadline: Optional[float] = None,
+                                       capture_errors: bool = False,
+                                       groups: Optional[List[Any]] = None) -> AsyncIterator[AdaptiveResult]:
+    """
+    Keep sampling each request (a dict of `agenerate` keyword arguments) until the confidence interval
+    on its mean score is narrower than `target_width`, or `max_samples` responses have been drawn.
+    `score(index, response)` scores one response of request `index`; responses it scores as None (and
+    failed calls) use up budget but don't count toward the interval.
+
+    Every request samples independently, so a noisy row never holds back a converged one. The first
+    `min_samples` are drawn together; after that, models that accept `n=` draw as many more as the spread
+    so far says the interval needs (capped by the budget) in one call, so the prompt is still billed once
+    per round, while the rest draw one at a time. Requests with fewer samples so far are served first. `groups` shares slots round-robin between
+    labelled requests, as in `aiter_generate_many`.
+    """
+    scheduler = FairScheduler(max_concurrency)
+    batch_id = object()
+    batch_deadline = Deadline(deadline) if deadline else None
+    min_samples = min(min_samples, max_samples)
+
+    async def draw(index, request, n, drawn):
+        group = groups[index] if groups is not None else None
+        async with batch_slot(scheduler, batch_id, group, drawn):
+            try:
+                return await agenerate_samples(**{"use_cache": False, **request, "n": n}, deadline=batch_deadline)
+            except Exception as exc:
+                if not capture_errors:
+                    raise
+                return [FailedResponse.from_exception(exc)] * n
+
+    async def run(index, request):
+        responses = []
+        scores = []
+        converged = False
+        multiple = supports_multiple_samples(request.get("model_type", "gpt-4"))
+        valid = []
+        while len(responses) < max_samples and not converged:
+            n = max(1, min_samples - len(responses))
+            if multiple and len(responses) >= min_samples:
+                # too few usable scores to estimate the spread yet: top them back up to `min_samples`
+                needed = samples_needed(valid, target_width) if len(valid) >= 2 else min_samples
+                n = max(1, min(max_samples - len(responses), needed - len(valid)))
+            if n > 1 and multiple:
+                batches = [await draw(index, request, n, len(responses))]
+            else:
+                batches = await asyncio.gather(*(draw(index, request, 1, len(responses)) for _ in range(n)))
+            for batch in batches:
+                for response in batch:
+                    responses.append(response)
+                    scores.append(None if isinstance(response, FailedResponse) else score(index, response))
+            valid = [s for s in scores if s is not None]
+            converged = len(valid) >= min_samples and ci_width(valid) <= target_width
+        return AdaptiveResult(index, responses, scores, converged)
+
+    tasks = [asyncio.ensure_future(run(index, request)) for index, request in enumerate(requests)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def iter_sample_until_converged(requests: Iterable[Dict[str, Any]], score: Callable[[int, str], Optional[float]],
+                                max_samples: int, target_width: float = DEFAULT_CI_WIDTH,
+                                min_samples: int = MIN_SAMPLES, max_concurrency: int = MAX_ASYNC_CONCURRENCY,
+                                deadline: Optional[float] = None, capture_errors: bool = False,
+                                groups: Optional[List[Any]] = None) -> Iterator[AdaptiveResult]:
+    """Blocking bridge to `aiter_sample_until_converged`."""
+    return iterate_sync(aiter_sample_until_converged(list(requests), score, max_samples, target_width, min_samples,
+                                                     max_concurrency, deadline, capture_errors, groups))
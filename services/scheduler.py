@@ -0,0 +1,103 @@
+import asyncio
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from .clients import MAX_ASYNC_CONCURRENCY
+
+Waiter = Tuple[float, int, asyncio.AbstractEventLoop, asyncio.Future]
+
+
+class FairScheduler:
+    """
+    Bounded work queue: at most `max_concurrency` holders at once. When a slot frees up it goes to the
+    next group in round-robin order, so a group with thousands of queued units can't starve one with a
+    few, and within a group to the waiter with the lowest `priority` (ties in arrival order).
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        # group -> heap of waiters; the order of the keys is the round-robin order
+        self._queues: "OrderedDict[Any, List[Waiter]]" = OrderedDict()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    async def acquire(self, group: Any = None, priority: float = 0):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_flight < self.max_concurrency and not self._queues:
+                self.in_flight += 1
+                return
+            waiter = loop.create_future()
+            heapq.heappush(self._queues.setdefault(group, []), (priority, next(self._sequence), loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # we were handed a slot just before being cancelled - pass it on
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            handoff = self._next_waiter()
+            if handoff is not None:
+                self.in_flight += 1
+        if handoff is not None:
+            loop, waiter = handoff
+            loop.call_soon_threadsafe(_resolve, waiter, self)
+
+    def _next_waiter(self) -> Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]:
+        while self._queues:
+            group, queue = self._queues.popitem(last=False)
+            _, _, loop, waiter = heapq.heappop(queue)
+            if queue:
+                # back of the line for this group's next unit
+                self._queues[group] = queue
+            if not waiter.done():
+                return loop, waiter
+        return None
+
+    @asynccontextmanager
+    async def slot(self, group: Any = None, priority: float = 0) -> AsyncIterator[None]:
+        await self.acquire(group, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def _resolve(waiter: asyncio.Future, scheduler: FairScheduler):
+    if waiter.done():
+        # cancelled while the handoff was in transit
+        scheduler.release()
+    else:
+        waiter.set_result(None)
+
+
+_scheduler: Optional[FairScheduler] = None
+_lock = threading.Lock()
+
+
+def get_scheduler() -> FairScheduler:
+    """The process-wide scheduler: every batch's requests share its MAX_ASYNC_CONCURRENCY slots."""
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler(MAX_ASYNC_CONCURRENCY)
+        return _scheduler
+
+
+@asynccontextmanager
+async def batch_slot(batch: FairScheduler, batch_id: Any, group: Any = None,
+                     priority: float = 0) -> AsyncIterator[None]:
+    """A slot in `batch` (shared fairly across its groups), then in the global scheduler (shared across batches)."""
+    async with batch.slot(group, priority):
+        async with get_scheduler().slot(batch_id):
+            yield
+
@@ -0,0 +1,41 @@
+import pandas as pd
+
+import services.llm_service as llm_service
+from prompts.evaluation_prompts import get_criteria
+from services.cache import ResponseCache
+from services.runner import run_evaluation
+
+
+def test_fused_response_missing_a_section_is_sent_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    monkeypatch.setattr(llm_service, "get_cache", lambda: cache)
+    monkeypatch.setattr(llm_service, "get_openai_api_key", lambda: "sk-test")
+
+    fused = next(criterion for criterion in get_criteria(fused=True) if 'criteria' in criterion)
+    titles = [member['title'] for member in fused['criteria']]
+    calls = []
+
+    async def fake_uncached(messages, model_type, n, timeout, deadline):
+        calls.append(messages)
+        if messages[0]["content"] != fused['prompt']:
+            return ["1"] * n
+        # every run, the model leaves out the last member's section
+        return ["".join(f"<{title}>1</{title}>" for title in titles[:-1])] * n
+
+    monkeypatch.setattr(llm_service, "_agenerate_uncached", fake_uncached)
+    df = pd.DataFrame({"notes": ["n0"], "transcript": ["t0"]})
+
+    def run():
+        calls.clear()
+        results = list(run_evaluation(df, "notes", "transcript", "gpt-4o", fused=True))
+        return [messages for messages in calls if messages[0]["content"] == fused['prompt']], results
+
+    first_calls, _ = run()
+    second_calls, second_results = run()
+
+    assert len(first_calls) == 1
+    # the incomplete answer wasn't cached, so the rerun asks the provider again
+    assert len(second_calls) == 1
+    missing = [result for result in second_results if result.column == titles[-1]]
+    assert missing and isinstance(missing[0].response, llm_service.FailedResponse)